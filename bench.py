@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+# Offline benchmark: runs export_saved_messages end to end against a local stand-in for
+# Telegram. The fake sits at the MTProto sender level, so the real Telethon client code,
+# ExportClient's rate limiter and every download path are exercised as in production.
+import asyncio
+import os
+import sys
+import argparse
+import hashlib
+import json
+import random
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+from collections import Counter
+from contextlib import redirect_stdout
+from datetime import datetime, timezone, timedelta
+from pathlib import Path
+from typing import Any
+
+from telethon import errors
+from telethon.sessions import StringSession
+from telethon.tl import functions as tl_functions
+from telethon.tl.tlobject import TLRequest
+from telethon.tl.types import (
+    Document,
+    DocumentAttributeAudio,
+    DocumentAttributeFilename,
+    InputDocumentFileLocation,
+    InputPhotoFileLocation,
+    InputUserSelf,
+    Message,
+    MessageFwdHeader,
+    MessageMediaDocument,
+    MessageMediaPhoto,
+    MessageMediaWebPage,
+    Photo,
+    PhotoSize,
+    PeerUser,
+    User,
+    WebPage,
+)
+from telethon.tl.types import messages as tl_messages
+from telethon.tl.types import storage as tl_storage
+from telethon.tl.types import upload as tl_upload
+
+import main
+
+
+SELF_ID = 1000
+# Authors of forwarded messages; a small pool so the entity cache sees repeats
+FORWARD_USERS = 200
+HISTORY_START = datetime(2020, 1, 1, tzinfo=timezone.utc)
+HISTORY_STEP = timedelta(minutes=10)
+# Base media size in KiB, set from --media-kb
+BENCH_MEDIA_KB = 16
+
+
+class FakeSender:
+    # Answers requests locally after a configurable delay; stands in for MTProtoSender
+    def __init__(self, n: int, latency: float, flood_rate: float, flood_seconds: int, media_kb: int, seed: int = 1) -> None:
+        self.n = n
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self.media_kb = media_kb
+        self.random = random.Random(seed)
+        self.requests: Counter = Counter()
+        self.floods = 0
+        self.bytes_served = 0
+
+    def send(self, request: Any, ordered: bool = False) -> "asyncio.Future[Any]":
+        fut = asyncio.get_running_loop().create_future()
+        asyncio.ensure_future(self._answer(request, fut))
+        return fut
+
+    async def _answer(self, request: Any, fut: "asyncio.Future[Any]") -> None:
+        inner = request
+        while isinstance(getattr(inner, "query", None), TLRequest):
+            inner = inner.query
+        name = type(inner).__name__
+        self.requests[name] += 1
+        await asyncio.sleep(self.latency)
+        if fut.done():
+            # The caller gave up on the request (a cancelled download)
+            return
+        if self.flood_rate and self.random.random() < self.flood_rate:
+            self.floods += 1
+            fut.set_exception(errors.FloodWaitError(request=inner, capture=self.flood_seconds))
+            return
+        try:
+            fut.set_result(self._result(inner))
+        except Exception as e:  # noqa: BLE001
+            fut.set_exception(e)
+
+    def _result(self, request: Any) -> Any:
+        if isinstance(request, tl_functions.messages.GetHistoryRequest):
+            return self._history(request)
+        if isinstance(request, tl_functions.messages.GetMessagesRequest):
+            # By id, as the --thumbnail-first originals pass asks
+            messages = [make_message(input_id.id) for input_id in request.id if 1 <= input_id.id <= self.n]
+            return tl_messages.Messages(messages=messages, topics=[], chats=[], users=[User(id=SELF_ID, access_hash=1, is_self=True, first_name="Bench")])
+        if isinstance(request, tl_functions.upload.GetFileRequest):
+            return self._file_part(request)
+        if isinstance(request, tl_functions.users.GetUsersRequest):
+            users = []
+            for input_user in request.id:
+                if isinstance(input_user, InputUserSelf):
+                    users.append(User(id=SELF_ID, access_hash=1, is_self=True, first_name="Bench", username="bench", phone="10000000000", premium=True))
+                else:
+                    users.append(forward_user(input_user.user_id))
+            return users
+        if isinstance(request, tl_functions.messages.TranscribeAudioRequest):
+            return tl_messages.TranscribedAudio(transcription_id=request.msg_id, text=f"transcript of message {request.msg_id}", pending=False)
+        raise errors.RPCError(request, f"{type(request).__name__} is not supported by the bench fake")
+
+    def _history(self, request: Any) -> Any:
+        # Saved Messages holds ids 1..n, newest first; offset_id wins over offset_date like on the server
+        if request.offset_id:
+            base = self.n - min(self.n, request.offset_id - 1)
+        elif request.offset_date:
+            newer = int((request.offset_date - HISTORY_START) / HISTORY_STEP)
+            base = self.n - min(self.n, max(0, newer))
+        else:
+            base = 0
+        start = max(0, base + request.add_offset)
+        end = max(0, min(self.n, base + request.add_offset + request.limit))
+        messages = [make_message(self.n - pos) for pos in range(start, end)]
+        users = {SELF_ID: User(id=SELF_ID, access_hash=1, is_self=True, first_name="Bench")}
+        for message in messages:
+            if message.fwd_from:
+                users[message.fwd_from.from_id.user_id] = forward_user(message.fwd_from.from_id.user_id)
+        return tl_messages.MessagesSlice(count=self.n, messages=messages, topics=[], chats=[], users=list(users.values()))
+
+    def _file_part(self, request: Any) -> Any:
+        location = request.location
+        size = media_size(location.id, self.media_kb)
+        if getattr(location, "thumb_size", "") == "m":
+            # 320px against the 1280px original: a sixteenth of the pixels
+            size //= 16
+        if isinstance(location, (InputPhotoFileLocation, InputDocumentFileLocation)):
+            data = media_bytes(location.id, request.offset, min(request.limit, max(0, size - request.offset)))
+        else:
+            data = b""
+        self.bytes_served += len(data)
+        return tl_upload.File(type=tl_storage.FilePartial(), mtime=0, bytes=data)
+
+
+class FakeTelegramClient(main.ExportClient):
+    # A real ExportClient that never opens a connection; all requests end up in FakeSender
+    def __init__(self, sender: FakeSender) -> None:
+        super().__init__(StringSession(), 1, "bench")
+        # Media lives on the "home" DC, so downloads never ask for an exported sender
+        self.session.set_dc(2, "127.0.0.1", 443)
+        self._sender = sender
+
+    async def connect(self) -> None:
+        return None
+
+    async def is_user_authorized(self) -> bool:
+        return True
+
+    async def disconnect(self) -> None:
+        return None
+
+
+def forward_user(user_id: int) -> User:
+    return User(id=user_id, access_hash=user_id, first_name=f"User {user_id}", username=f"user{user_id}")
+
+
+# Media ids encode their kind in the last digit: 1 photo, 2 document, 3 voice note, 4 link preview photo
+def media_size(media_id: int, media_kb: int) -> int:
+    kind = media_id % 10
+    scale = {1: 4, 2: 16, 3: 1, 4: 2}.get(kind, 1)
+    return media_kb * 1024 * scale + media_id % 997
+
+
+def media_bytes(media_id: int, offset: int, length: int) -> bytes:
+    block = hashlib.sha256(str(media_id).encode()).digest() * 128
+    start = offset % len(block)
+    data = (block * (2 + (start + length) // len(block)))[start:start + length]
+    return data
+
+
+def make_photo(media_id: int, date: datetime) -> Photo:
+    size = media_size(media_id, BENCH_MEDIA_KB)
+    sizes = [PhotoSize(type="m", w=320, h=240, size=size // 16), PhotoSize(type="y", w=1280, h=960, size=size)]
+    return Photo(id=media_id, access_hash=1, file_reference=b"", date=date, sizes=sizes, dc_id=2)
+
+
+def make_message(msg_id: int) -> Message:
+    date = HISTORY_START + HISTORY_STEP * msg_id
+    kind = msg_id % 20
+    media: Any = None
+    text = f"Bench message {msg_id} with a link https://example.com/{msg_id} and some text to escape <&>"
+    if kind in (1, 7, 13):
+        media = MessageMediaPhoto(photo=make_photo(msg_id * 10 + 1, date))
+    elif kind == 4:
+        doc_id = msg_id * 10 + 2
+        media = MessageMediaDocument(document=Document(
+            id=doc_id, access_hash=1, file_reference=b"", date=date, mime_type="application/pdf",
+            size=media_size(doc_id, BENCH_MEDIA_KB), dc_id=2, attributes=[DocumentAttributeFilename(file_name=f"report_{msg_id}.pdf")],
+        ))
+    elif kind == 9:
+        doc_id = msg_id * 10 + 3
+        media = MessageMediaDocument(document=Document(
+            id=doc_id, access_hash=1, file_reference=b"", date=date, mime_type="audio/ogg",
+            size=media_size(doc_id, BENCH_MEDIA_KB), dc_id=2, attributes=[DocumentAttributeAudio(duration=5, voice=True)],
+        ))
+        text = ""
+    elif kind == 16:
+        media = MessageMediaWebPage(webpage=WebPage(
+            id=msg_id, url=f"https://example.com/{msg_id}", display_url=f"example.com/{msg_id}", hash=0,
+            title=f"Page {msg_id}", description="Link preview", photo=make_photo(msg_id * 10 + 4, date),
+        ))
+    fwd = MessageFwdHeader(date=date, from_id=PeerUser(2000 + msg_id % FORWARD_USERS)) if msg_id % 6 == 0 else None
+    return Message(id=msg_id, peer_id=PeerUser(SELF_ID), date=date, message=text, out=True, media=media, fwd_from=fwd)
+
+
+
+def export_args(output: Path, opts: argparse.Namespace) -> argparse.Namespace:
+    saved_argv = sys.argv
+    sys.argv = ["main.py", "--api-id", "1", "--api-hash", "bench", "--output", str(output),
+                "--download-workers", str(opts.download_workers), "--archive", opts.archive, "--originals", opts.originals]
+    if opts.thumbnail_first:
+        sys.argv.append("--thumbnail-first")
+    try:
+        return main.parse_args()
+    finally:
+        sys.argv = saved_argv
+
+
+def run_one(n: int, opts: argparse.Namespace) -> dict:
+    global BENCH_MEDIA_KB
+    BENCH_MEDIA_KB = opts.media_kb
+    if opts.rate_limits == "off":
+        # Measure the exporter rather than the pacing: lift every bucket far above what the fake needs
+        for name in main.RATE_LIMITS:
+            main.RATE_LIMITS[name] = (1e6, 1e6)
+    output = Path(tempfile.mkdtemp(prefix="tgm_bench_"))
+    sender = FakeSender(n, latency=opts.latency_ms / 1000, flood_rate=opts.flood_rate, flood_seconds=opts.flood_seconds, media_kb=opts.media_kb)
+    client = FakeTelegramClient(sender)
+    args = export_args(output, opts)
+    started = time.perf_counter()
+    try:
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            run_dir = asyncio.run(main.export_saved_messages(args, client=client))
+        wall = time.perf_counter() - started
+        output_bytes = sum(p.stat().st_size for p in run_dir.rglob("*") if p.is_file())
+        phases = json.loads((run_dir / main.METRICS_FILE).read_text(encoding="utf-8"))["phases"]
+    finally:
+        if not opts.keep:
+            shutil.rmtree(output, ignore_errors=True)
+    return {
+        "messages": n,
+        "wall_s": round(wall, 3),
+        "msgs_per_s": round(n / wall, 1),
+        "media_bytes": sender.bytes_served,
+        "bytes_per_s": round(sender.bytes_served / wall),
+        "output_bytes": output_bytes,
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "api_calls": dict(client.limiter.calls),
+        "requests": dict(sender.requests),
+        "flood_waits": client.limiter.flood_waits,
+        "retries": client.limiter.retries,
+        "phases": phases,
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the Saved Messages exporter against a local fake Telegram")
+    parser.add_argument("--sizes", type=str, default="1000,10000,100000", help="Comma-separated message counts to run (default: 1000,10000,100000)")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="Simulated round-trip time per request (default: 20)")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="Probability that a request gets a FloodWait (default: 0)")
+    parser.add_argument("--flood-seconds", type=int, default=1, help="FloodWait duration in seconds (default: 1)")
+    parser.add_argument("--media-kb", type=int, default=16, help="Base media size in KiB; documents are 16x, photos 4x (default: 16)")
+    parser.add_argument("--rate-limits", choices=["off", "on"], default="off", help="Keep the production request rates (on) or lift them (off, default)")
+    parser.add_argument("--download-workers", type=int, default=4, help="Passed through to the exporter (default: 4)")
+    parser.add_argument("--archive", choices=["zip", "tar", "none"], default="zip", help="Passed through to the exporter (default: zip)")
+    parser.add_argument("--thumbnail-first", action="store_true", help="Passed through to the exporter")
+    parser.add_argument("--originals", type=str, default="*", help="Passed through to the exporter (default: *)")
+    parser.add_argument("--keep", action="store_true", help="Keep the generated exports in the temp directory")
+    parser.add_argument("--json", action="store_true", help="Print one JSON object per run instead of a table")
+    parser.add_argument("--one", type=int, default=0, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main_cli() -> int:
+    opts = parse_args()
+    if opts.one:
+        print(json.dumps(run_one(opts.one, opts)))
+        return 0
+    # Each size runs in its own process so peak RSS is measured per run
+    passthrough = [
+        "--latency-ms", str(opts.latency_ms), "--flood-rate", str(opts.flood_rate), "--flood-seconds", str(opts.flood_seconds),
+        "--media-kb", str(opts.media_kb), "--rate-limits", opts.rate_limits,
+        "--download-workers", str(opts.download_workers), "--archive", opts.archive,
+        "--originals", opts.originals,
+    ] + (["--keep"] if opts.keep else []) + (["--thumbnail-first"] if opts.thumbnail_first else [])
+    results = []
+    for n in [int(x) for x in opts.sizes.split(",") if x.strip()]:
+        proc = subprocess.run([sys.executable, __file__, "--one", str(n)] + passthrough, capture_output=True, text=True)
+        if proc.returncode != 0:
+            print(f"Run with {n} messages failed:\n{proc.stderr}")
+            return 1
+        result = json.loads(proc.stdout.strip().splitlines()[-1])
+        results.append(result)
+        if opts.json:
+            print(json.dumps(result))
+    if not opts.json:
+        print(f"{'messages':>9} {'wall s':>9} {'msgs/s':>9} {'MB/s':>8} {'RSS MB':>8} {'requests':>9} {'floods':>7}  calls by class")
+        for r in results:
+            calls = " ".join(f"{k}={v}" for k, v in r["api_calls"].items() if v)
+            print(f"{r['messages']:>9} {r['wall_s']:>9.2f} {r['msgs_per_s']:>9.1f} {r['bytes_per_s'] / 1e6:>8.2f} {r['peak_rss_mb']:>8.1f} {sum(r['requests'].values()):>9} {r['flood_waits']:>7}  {calls}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -1,23 +1,46 @@
 #!/usr/bin/env python3
+import array
 import asyncio
 import os
 import sys
+import fnmatch
+import hashlib
 import html
 import json
+import multiprocessing
 import re
 import argparse
 import shutil
+import subprocess
+import tarfile
 import time
+import zipfile
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import AsyncExitStack, contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
 from datetime import datetime, timezone, timedelta
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterator, Optional, Tuple
 
 from telethon import TelegramClient
+from telethon import events
+from telethon import utils as tl_utils
 from telethon.sessions import StringSession
+from telethon import errors
 from telethon.errors import SessionPasswordNeededError
+from telethon.tl.tlobject import TLRequest
 from telethon.tl.types import Message, MessageMediaPhoto, MessageMediaDocument, MessageMediaWebPage
 from telethon.tl import functions as tl_functions
 from telethon.tl.types import DocumentAttributeAudio, DocumentAttributeVideo
+from telethon.tl.types import InputPeerSelf, Photo, Document, UpdateTranscribedAudio
+from telethon.tl.types import PhotoCachedSize, PhotoSize, PhotoSizeProgressive
+from telethon.tl.types import Channel, ChannelForbidden, Chat, ChatForbidden
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # optional, only --derivatives uses it
+    Image = None
 
 
 CSS_STYLE = """
@@ -36,6 +59,9 @@ body { font-family: system-ui, -apple-system, Segoe UI, Roboto, Ubuntu, Cantarel
 .media { margin-top: 12px; }
 img.media-img { max-width: 100%; height: auto; border-radius: 8px; border: 1px solid #232735; }
 video.media-vid, audio.media-aud { max-width: 100%; display: block; }
+img.media-wave { display: block; height: 28px; margin-bottom: 6px; }
+a.media-thumb { position: relative; display: inline-block; }
+a.media-thumb .play { position: absolute; left: 50%; top: 50%; transform: translate(-50%, -50%); background: #000a; color: #fff; border-radius: 50%; width: 44px; height: 44px; line-height: 44px; text-align: center; font-size: 18px; }
 .file-link { display: inline-flex; align-items: center; gap: 8px; color: #d2d2d2; }
 .badge { font-size: 10px; padding: 2px 6px; border: 1px solid #333a4a; border-radius: 6px; color: #9aa4b2; }
 code { background: #1a1f2b; border: 1px solid #232735; padding: 1px 4px; border-radius: 4px; }
@@ -49,6 +75,140 @@ pre { background: #1a1f2b; border: 1px solid #232735; padding: 12px; border-radi
 .link-preview .title { color: #e6e6e6; font-weight: 600; margin: 0 0 6px 0; font-size: 14px; }
 .link-preview .desc { color: #c9d1d9; font-size: 12px; line-height: 1.4; }
 .link-preview a { color: #8ab4ff; text-decoration: none; }
+.nav { display: flex; gap: 16px; margin-top: 8px; font-size: 12px; }
+.nav a { color: #8ab4ff; text-decoration: none; }
+.nav a.disabled { color: #4a5060; pointer-events: none; }
+.page-link { padding: 10px 16px; border-bottom: 1px solid #1e212a; display: flex; justify-content: space-between; }
+.page-link a { color: #8ab4ff; text-decoration: none; }
+.search { position: relative; margin-top: 8px; }
+.search input { width: 100%; box-sizing: border-box; background: #131725; color: #e6e6e6; border: 1px solid #232735; border-radius: 8px; padding: 6px 10px; font-size: 13px; }
+.search-results { position: absolute; left: 0; right: 0; max-height: 60vh; overflow: auto; background: #131725; border: 1px solid #232735; border-radius: 8px; margin-top: 4px; }
+.search-results:empty { display: none; }
+.search-results a { display: block; padding: 8px 12px; color: #c9d1d9; text-decoration: none; border-bottom: 1px solid #1e212a; font-size: 13px; }
+.search-results a:hover { background: #1a1f2b; }
+.search-results .msg-id { margin-right: 8px; }
+.search-results .status { padding: 8px 12px; color: #9aa4b2; font-size: 12px; }
+"""
+
+# Search box: loads search/t_<key>.js shards for the query's words and search/d_<n>.js summaries
+# for the hits through <script> tags (fetch() is not allowed from file://). Shard files are
+# append-only calls to SEARCH_T/SEARCH_D; a negative id in a posting list removes the message.
+SEARCH_JS = """
+(function () {
+  var tokens = {}, docs = {}, scripts = {};
+  window.SEARCH_T = function (key, postings) {
+    var shard = tokens[key] || (tokens[key] = {});
+    for (var tok in postings) {
+      var ids = shard[tok] || (shard[tok] = {});
+      postings[tok].forEach(function (id) { if (id < 0) delete ids[-id]; else ids[id] = true; });
+    }
+  };
+  window.SEARCH_D = function (entries) { entries.forEach(function (d) { docs[d[0]] = d; }); };
+  function load(file, done) {
+    var state = scripts[file];
+    if (state === true) return done();
+    if (state) return state.push(done);
+    scripts[file] = [done];
+    var el = document.createElement("script");
+    el.src = "search/" + file;
+    el.onload = el.onerror = function () {
+      var waiting = scripts[file];
+      scripts[file] = true;
+      waiting.forEach(function (cb) { cb(); });
+    };
+    document.head.appendChild(el);
+  }
+  function loadAll(files, done) {
+    var left = files.length;
+    if (!left) return done();
+    files.forEach(function (f) { load(f, function () { if (--left === 0) done(); }); });
+  }
+  function shardKey(tok) {
+    return Array.from(tok).slice(0, 2).map(function (c) { return c.codePointAt(0).toString(16); }).join("_");
+  }
+  function words(text) {
+    return (text.toLowerCase().match(/[\\p{L}\\p{N}_]+/gu) || []).filter(function (w) { return Array.from(w).length >= 2; });
+  }
+  function search(query, box) {
+    var results = box.querySelector(".search-results");
+    var ws = words(query);
+    if (!ws.length) { results.innerHTML = ""; return; }
+    var keys = ws.map(function (w) { return Array.from(w).slice(0, 2).join(""); });
+    loadAll(keys.map(function (k) { return "t_" + shardKey(k) + ".js"; }), function () {
+      var hits = null;
+      ws.forEach(function (w, i) {
+        var shard = tokens[keys[i]] || {}, found = {};
+        for (var tok in shard) if (tok.lastIndexOf(w, 0) === 0) for (var id in shard[tok]) found[id] = true;
+        if (hits === null) hits = found;
+        else for (var id in hits) if (!found[id]) delete hits[id];
+      });
+      var ids = Object.keys(hits || {}).map(Number).sort(function (a, b) { return b - a; });
+      var total = ids.length, shown = ids.slice(0, 100);
+      var docFiles = {};
+      shown.forEach(function (id) { docFiles["d_" + Math.floor(id / 1000) + ".js"] = true; });
+      loadAll(Object.keys(docFiles), function () {
+        results.innerHTML = "";
+        shown.forEach(function (id) {
+          var d = docs[id] || [id, "", ""];
+          var a = document.createElement("a");
+          a.href = "#msg-" + id;
+          var head = document.createElement("span");
+          head.className = "msg-id";
+          head.textContent = "#" + id + " " + d[1];
+          a.appendChild(head);
+          a.appendChild(document.createTextNode(d[2]));
+          results.appendChild(a);
+        });
+        var status = document.createElement("div");
+        status.className = "status";
+        status.textContent = total ? box.getAttribute("data-found").replace("{count}", total) : box.getAttribute("data-none");
+        results.appendChild(status);
+      });
+    });
+  }
+  document.addEventListener("DOMContentLoaded", function () {
+    var box = document.querySelector(".search");
+    if (!box) return;
+    var input = box.querySelector("input"), timer = null;
+    input.addEventListener("input", function () {
+      clearTimeout(timer);
+      timer = setTimeout(function () { search(input.value, box); }, 250);
+    });
+    box.querySelector(".search-results").addEventListener("click", function (e) {
+      if (e.target.closest("a")) box.querySelector(".search-results").innerHTML = "";
+    });
+  });
+})();
+"""
+
+# Shared by sharded pages and their index: fills prev/next links from pages.js and sends
+# #msg-<id> anchors to whichever page holds that message
+SHARD_NAV_JS = """
+(function () {
+  var pages = window.EXPORT_PAGES || [];
+  var here = decodeURIComponent(location.pathname.split("/").pop()) || "index.html";
+  function resolve() {
+    var m = /^#msg-(\\d+)$/.exec(location.hash);
+    if (!m || document.getElementById("msg-" + m[1])) return;
+    var id = parseInt(m[1], 10);
+    for (var i = 0; i < pages.length; i++) {
+      if (id >= pages[i].min && id <= pages[i].max && pages[i].file !== here) {
+        location.replace(pages[i].file + location.hash);
+        return;
+      }
+    }
+  }
+  document.addEventListener("DOMContentLoaded", function () {
+    var idx = -1;
+    for (var i = 0; i < pages.length; i++) if (pages[i].file === here) idx = i;
+    document.querySelectorAll("[data-nav]").forEach(function (a) {
+      var target = idx >= 0 ? pages[idx + (a.getAttribute("data-nav") === "next" ? 1 : -1)] : null;
+      if (target) a.href = target.file; else a.className = "disabled";
+    });
+    resolve();
+  });
+  window.addEventListener("hashchange", resolve);
+})();
 """
 
 
@@ -66,9 +226,41 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("--lang", type=str, default=os.environ.get("EXPORT_LANG", "ru"), choices=["en", "ru"], help="Interface language (default: ru; use 'en' to switch)")
     parser.add_argument("--lang-file", type=str, default=os.environ.get("EXPORT_LANG_FILE", ""), help="Path to JSON with translation overrides { key: template }")
     parser.add_argument("--keep-last", type=int, default=int(os.environ.get("EXPORT_KEEP_LAST", "0")), help="After export, keep only the last N export runs (0 = keep all)")
+    parser.add_argument("--incremental", action="store_true", default=os.environ.get("EXPORT_INCREMENTAL", "") == "1", help="Only fetch messages newer than the last export (plus recent edits) and reuse everything already archived")
+    parser.add_argument("--edit-window-days", type=int, default=int(os.environ.get("EXPORT_EDIT_WINDOW_DAYS", "7")), help="With --incremental, re-check messages from the last N days for edits (default: 7)")
+    parser.add_argument("--shard", type=str, default=os.environ.get("EXPORT_SHARD", "none"), choices=["none", "month"], help="Split the HTML into one page per month with a small index page (default: none)")
+    parser.add_argument("--entity-ttl-hours", type=float, default=float(os.environ.get("EXPORT_ENTITY_TTL_HOURS", "168")), help="How long resolved forward sources stay cached in entities.json (default: 168)")
+    parser.add_argument("--transcribe-workers", type=int, default=int(os.environ.get("EXPORT_TRANSCRIBE_WORKERS", "2")), help="Concurrent Telegram transcription requests for Premium accounts (default: 2)")
+    parser.add_argument("--takeout", action="store_true", default=os.environ.get("EXPORT_TAKEOUT", "") == "1", help="Fetch history and media through a Telegram takeout session (relaxed limits; may need approval in another app)")
+    parser.add_argument("--resume", type=str, default="", help="Continue an interrupted export in this run directory from its last checkpoint")
+    parser.add_argument("--archive", choices=["zip", "tar", "none"], default=os.environ.get("EXPORT_ARCHIVE", "zip"), help="Archive the run directory as it is written: zip (default), tar or none")
+    parser.add_argument("--metrics-textfile", type=str, default=os.environ.get("EXPORT_METRICS_TEXTFILE", ""), help="Also write run metrics to this Prometheus textfile-collector file (*.prom)")
+    parser.add_argument("--render-processes", type=int, default=int(os.environ.get("EXPORT_RENDER_PROCESSES", "0")), help="Render HTML in this many worker processes (default: 0, a single background thread)")
+    parser.add_argument("--no-search", action="store_true", default=os.environ.get("EXPORT_NO_SEARCH", "") == "1", help="Do not build the full-text search index and search box")
+    parser.add_argument("--targets", type=str, default=os.environ.get("EXPORT_TARGETS", ""), help="JSON file listing accounts and chats to export concurrently (see README)")
+    parser.add_argument("--thumbnail-first", action="store_true", default=os.environ.get("EXPORT_THUMBNAIL_FIRST", "") == "1", help="Show Telegram's thumbnails of photos and videos and fetch the originals in a later pass")
+    parser.add_argument("--originals", type=str, default=os.environ.get("EXPORT_ORIGINALS", "*"), help="With --thumbnail-first, MIME types whose originals are fetched, comma-separated with wildcards (default: *; 'none' keeps thumbnails only)")
+    parser.add_argument("--originals-max-bytes", type=int, default=int(os.environ.get("EXPORT_ORIGINALS_MAX_BYTES", "0")), help="With --thumbnail-first, skip originals larger than this many bytes (0 = no limit)")
+    parser.add_argument("--parallel-download-bytes", type=int, default=int(os.environ.get("EXPORT_PARALLEL_DOWNLOAD_BYTES", str(32 * 1024 * 1024))), help="Download documents larger than this many bytes as parallel byte ranges (default: 32 MiB, 0 = never)")
+    parser.add_argument("--parallel-download-parts", type=int, default=int(os.environ.get("EXPORT_PARALLEL_DOWNLOAD_PARTS", "4")), help="Byte ranges fetched at once for such documents (default: 4)")
+    parser.add_argument("--watch", action="store_true", default=os.environ.get("EXPORT_WATCH", "") == "1", help="After the export, keep running and add new and edited messages to it as they arrive")
+    parser.add_argument("--watch-archive-minutes", type=float, default=float(os.environ.get("EXPORT_WATCH_ARCHIVE_MINUTES", "15")), help="With --watch, rebuild the archive at most this often once something changed (default: 15)")
+    parser.add_argument("--derivatives", action="store_true", default=os.environ.get("EXPORT_DERIVATIVES", "") == "1", help="Show web-sized copies of images, poster frames of videos and waveforms of voice notes (needs Pillow and ffmpeg)")
+    parser.add_argument("--derivative-processes", type=int, default=int(os.environ.get("EXPORT_DERIVATIVE_PROCESSES", "2")), help="With --derivatives, worker processes making them (default: 2)")
+    parser.add_argument("--download-workers", type=int, default=int(os.environ.get("EXPORT_DOWNLOAD_WORKERS", "4")), help="Number of media downloads running in parallel (default: 4)")
     return parser.parse_args()
 
 
+def parse_render_args(argv: list[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="main.py render", description="Rebuild the HTML of an export run from its messages.jsonl, without connecting to Telegram.")
+    parser.add_argument("run_dir", type=str, help="Export run directory (saved_messages_DDMMYYYY_HHMMSS)")
+    parser.add_argument("--lang", type=str, default=None, choices=["en", "ru"], help="Interface language (default: the one the run was exported with)")
+    parser.add_argument("--lang-file", type=str, default=os.environ.get("EXPORT_LANG_FILE", ""), help="Path to JSON with translation overrides { key: template }")
+    parser.add_argument("--reverse", action=argparse.BooleanOptionalAction, default=None, help="Oldest-to-newest order (default: the run's order)")
+    parser.add_argument("--shard", type=str, default=None, choices=["none", "month"], help="Single page or one page per month (default: the run's layout)")
+    return parser.parse_args(argv)
+
+
 def ensure_output_dirs(base_dir: Path) -> Tuple[Path, Path]:
     timestamp = datetime.now().strftime("%d%m%Y_%H%M%S")
     run_dir = base_dir / f"saved_messages_{timestamp}"
@@ -77,6 +269,635 @@ def ensure_output_dirs(base_dir: Path) -> Tuple[Path, Path]:
     return run_dir, media_dir
 
 
+MESSAGES_JOURNAL = "messages.jsonl"
+RUN_SETTINGS_FILE = "run.json"
+# Options that decide what a run contains and in which order; --resume restores them from run.json
+RESUME_SETTINGS = ("since", "until", "reverse", "shard", "lang", "dry_run", "max_bytes", "thumbnail_first", "no_search")
+STATE_FILE = ".export_state.json"
+MEDIA_STORE_DIR = "media_store"
+ENTITY_CACHE_FILE = "entities.json"
+TRANSCRIPTS_FILE = "transcripts.json"
+METRICS_FILE = "metrics.json"
+SEARCH_DIR = "search"
+
+
+def load_run_settings(run_dir: Path) -> dict:
+    try:
+        settings = json.loads((run_dir / RUN_SETTINGS_FILE).read_text(encoding="utf-8"))
+        return settings if isinstance(settings, dict) else {}
+    except FileNotFoundError:
+        return {}
+
+
+def save_run_settings(run_dir: Path, settings: dict) -> None:
+    tmp_path = run_dir / (RUN_SETTINGS_FILE + ".tmp")
+    tmp_path.write_text(json.dumps(settings), encoding="utf-8")
+    os.replace(tmp_path, run_dir / RUN_SETTINGS_FILE)
+
+
+def load_export_state(output_dir: Path) -> dict:
+    try:
+        state = json.loads((output_dir / STATE_FILE).read_text(encoding="utf-8"))
+        return state if isinstance(state, dict) else {}
+    except FileNotFoundError:
+        return {}
+    except Exception as e:  # noqa: BLE001
+        print(f"Ignoring unreadable export state: {e}")
+        return {}
+
+
+def save_export_state(output_dir: Path, state: dict) -> None:
+    # Write-then-rename so an interrupted run never leaves a truncated state behind
+    tmp_path = output_dir / (STATE_FILE + ".tmp")
+    tmp_path.write_text(json.dumps(state), encoding="utf-8")
+    os.replace(tmp_path, output_dir / STATE_FILE)
+
+
+def read_jsonl(path: Path) -> Iterator[dict]:
+    # A crash can leave a torn last line; it is cut off so appends continue cleanly
+    if not path.exists():
+        return
+    good_offset = 0
+    with path.open("rb") as fh:
+        for line in fh:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                break
+            good_offset += len(line)
+            if isinstance(rec, dict):
+                yield rec
+    if good_offset != path.stat().st_size:
+        with path.open("r+b") as fh:
+            fh.truncate(good_offset)
+
+
+class Journal:
+    # Append-only checkpoint log of a run (messages.jsonl): one record per exported message
+    # (see extract_record), in output order, and one line per media file that finished
+    # downloading. The records are all the render subcommand needs to rebuild the HTML.
+    def __init__(self, path: Path) -> None:
+        self._fh = path.open("a", encoding="utf-8")
+
+    def _append(self, rec: dict) -> None:
+        self._fh.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        self._fh.flush()
+
+    def message(self, rec: dict) -> int:
+        # The byte offset of the record, where --watch reads it back when the message is edited
+        offset = self._fh.tell()
+        self._append(rec)
+        return offset
+
+    def media(self, rel_path: str, size: int) -> None:
+        self._append({"media": rel_path, "size": size})
+
+    def close(self) -> None:
+        self._fh.close()
+
+
+# Records are written with their id first (see extract_record), so a journal can be scanned without parsing it
+_JOURNAL_ID_RE = re.compile(rb'\{"id": (-?\d+)')
+
+
+def iter_journal_records(run_dir: Path, reverse: bool, was_reverse: bool) -> Iterator[dict]:
+    path = run_dir / MESSAGES_JOURNAL
+
+    def _key(msg_id: int) -> int:
+        return msg_id if was_reverse else -msg_id
+
+    def _records() -> Iterator[dict]:
+        # --watch appends new and edited messages instead of rewriting the journal. A record out of
+        # page order is one of those: it replaces the earlier record with its id or, for a new
+        # message, goes where the page has it. There are few of them, so they are read up front.
+        late: dict[int, dict] = {}
+        last: Optional[int] = None
+        if path.exists():
+            with path.open("rb") as fh:
+                for line in fh:
+                    match = _JOURNAL_ID_RE.match(line)
+                    if not match:
+                        continue
+                    key = _key(int(match.group(1)))
+                    if last is None or key > last:
+                        last = key
+                        continue
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        break
+                    late[int(rec["id"])] = rec
+        slotted = sorted(late, key=_key)
+        i = 0
+        last = None
+        for rec in read_jsonl(path):
+            if "id" not in rec:
+                continue
+            key = _key(int(rec["id"]))
+            if last is not None and key <= last:
+                continue
+            last = key
+            while i < len(slotted) and _key(slotted[i]) < key:
+                yield late[slotted[i]]
+                i += 1
+            if i < len(slotted) and _key(slotted[i]) == key:
+                rec = late[slotted[i]]
+                i += 1
+            yield rec
+        for msg_id in slotted[i:]:
+            yield late[msg_id]
+
+    if reverse == was_reverse:
+        yield from _records()
+    else:
+        # The previous run was rendered in the other order; this needs the whole journal in memory
+        yield from reversed(list(_records()))
+
+
+# Words of at least two characters; the first two pick the index file a word lives in
+_WORD_RE = re.compile(r"\w{2,}")
+SEARCH_DOCS_PER_FILE = 1000
+SEARCH_FLUSH_EVERY = 5000
+SEARCH_SNIPPET_CHARS = 140
+SEARCH_WORD_CHARS = 40
+
+
+def search_text(rec: dict) -> str:
+    # Everything a reader would expect to find a message by: text, transcript, link preview, forward source
+    parts = [rec.get("text") or ""]
+    attachment = rec.get("attachment") or {}
+    if attachment.get("type") == "file":
+        parts.append(attachment.get("transcript") or "")
+    elif attachment.get("type") == "webpage":
+        parts.extend(attachment.get(key) or "" for key in ("site", "title", "description"))
+    fwd = rec.get("fwd") or {}
+    parts.extend(fwd.get(key) or "" for key in ("from_name", "name", "username"))
+    return "\n".join(part for part in parts if part)
+
+
+class SearchIndex:
+    # Static full-text index next to the pages, for the search box (SEARCH_JS) to load over file://:
+    # search/t_<key>.js holds the message ids of every word starting with the same two characters,
+    # search/d_<n>.js the date and a snippet of messages n*1000 .. n*1000+999. Both are appended to
+    # in chunks, so memory is bounded by SEARCH_FLUSH_EVERY messages rather than the history.
+    # --watch keeps appending to the index of its run, and --incremental to a copy of the previous
+    # run's; a negative id takes a message out of a word.
+    def __init__(self, run_dir: Path, reset: bool = True) -> None:
+        self.dir = run_dir / SEARCH_DIR
+        if reset:
+            # Rebuilt from scratch with the pages; a resumed run replays its journal into it
+            shutil.rmtree(self.dir, ignore_errors=True)
+        self.dir.mkdir(exist_ok=True)
+        self._postings: dict[str, dict[str, list[int]]] = {}
+        self._docs: dict[int, list[list]] = {}
+        self._pending = 0
+
+    def _words(self, text: str) -> set[str]:
+        return {word[:SEARCH_WORD_CHARS] for word in _WORD_RE.findall(text.lower())}
+
+    def remove(self, rec: dict) -> None:
+        for word in self._words(search_text(rec)):
+            self._postings.setdefault(word[:2], {}).setdefault(word, []).append(-int(rec["id"]))
+
+    def add(self, rec: dict) -> None:
+        msg_id = int(rec["id"])
+        text = search_text(rec)
+        for word in self._words(text):
+            self._postings.setdefault(word[:2], {}).setdefault(word, []).append(msg_id)
+        snippet = " ".join(text.split())
+        if len(snippet) > SEARCH_SNIPPET_CHARS:
+            snippet = snippet[:SEARCH_SNIPPET_CHARS - 1] + "…"
+        self._docs.setdefault(msg_id // SEARCH_DOCS_PER_FILE, []).append([msg_id, rec["date"][:10], snippet])
+        self._pending += 1
+        if self._pending >= SEARCH_FLUSH_EVERY:
+            self.flush()
+
+    def _append(self, name: str, call: str, *payload: Any) -> None:
+        encoded = ",".join(json.dumps(arg, ensure_ascii=False, separators=(",", ":")) for arg in payload)
+        with (self.dir / name).open("a", encoding="utf-8") as fh:
+            fh.write(f"{call}({encoded});\n")
+
+    def flush(self) -> None:
+        for key, words in self._postings.items():
+            file_key = "_".join(f"{ord(ch):x}" for ch in key)
+            self._append(f"t_{file_key}.js", "SEARCH_T", key, words)
+        for n, docs in self._docs.items():
+            self._append(f"d_{n}.js", "SEARCH_D", docs)
+        self._postings.clear()
+        self._docs.clear()
+        self._pending = 0
+
+
+class Metrics:
+    # Per-run phase timings and counters, written to metrics.json in the run directory and
+    # optionally to a Prometheus textfile. Phases hold busy time summed over all tasks, so the
+    # concurrent ones (download, transcription) can add up to more than the wall time.
+    def __init__(self) -> None:
+        self.started = datetime.now(timezone.utc)
+        self._t0 = time.perf_counter()
+        self.phases: dict[str, float] = {}
+        self.counters: dict[str, int] = {}
+        # Requests of this run only; the rate limiter of a --targets account serves several runs
+        self.api_calls: dict[str, int] = {}
+        self.flood_waits = 0
+        self.retries = 0
+
+    def add(self, phase: str, seconds: float) -> None:
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def count(self, name: str, n: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    async def timed_iter(self, it: AsyncIterator[Any], phase: str) -> AsyncIterator[Any]:
+        while True:
+            started = time.perf_counter()
+            try:
+                item = await it.__anext__()
+            except StopAsyncIteration:
+                return
+            finally:
+                self.add(phase, time.perf_counter() - started)
+            yield item
+
+    def api_call(self, name: str) -> None:
+        self.api_calls[name] = self.api_calls.get(name, 0) + 1
+
+    def summary(self) -> dict:
+        return {
+            "started": self.started.isoformat(),
+            "wall_seconds": round(time.perf_counter() - self._t0, 3),
+            "phases": {name: round(seconds, 3) for name, seconds in self.phases.items()},
+            "counters": dict(self.counters),
+            "api": {
+                "calls": dict(self.api_calls),
+                "flood_waits": self.flood_waits,
+                "retries": self.retries,
+            },
+        }
+
+    def write(self, run_dir: Path, textfile: str = "") -> None:
+        summary = self.summary()
+        try:
+            (run_dir / METRICS_FILE).write_text(json.dumps(summary, indent=2), encoding="utf-8")
+        except Exception as e:  # noqa: BLE001
+            print(f"Failed to write {METRICS_FILE}: {e}")
+        if not textfile:
+            return
+        lines = [
+            "# HELP tgm_export_duration_seconds Wall time of the last export run.",
+            "# TYPE tgm_export_duration_seconds gauge",
+            f"tgm_export_duration_seconds {summary['wall_seconds']}",
+            "# HELP tgm_export_last_run_timestamp_seconds Start time of the last export run.",
+            "# TYPE tgm_export_last_run_timestamp_seconds gauge",
+            f"tgm_export_last_run_timestamp_seconds {int(self.started.timestamp())}",
+            "# HELP tgm_export_phase_seconds Busy time per export phase.",
+            "# TYPE tgm_export_phase_seconds gauge",
+        ]
+        lines += [f'tgm_export_phase_seconds{{phase="{name}"}} {seconds}' for name, seconds in summary["phases"].items()]
+        lines += ["# HELP tgm_export_count Items processed by the last export run.", "# TYPE tgm_export_count gauge"]
+        lines += [f'tgm_export_count{{item="{name}"}} {value}' for name, value in summary["counters"].items()]
+        lines += ["# HELP tgm_export_api_calls Telegram API calls per request class.", "# TYPE tgm_export_api_calls gauge"]
+        lines += [f'tgm_export_api_calls{{class="{name}"}} {value}' for name, value in summary["api"]["calls"].items()]
+        lines += [
+            "# HELP tgm_export_flood_waits FloodWait errors received.",
+            "# TYPE tgm_export_flood_waits gauge",
+            f"tgm_export_flood_waits {summary['api']['flood_waits']}",
+            "# HELP tgm_export_api_retries Requests retried after a FloodWait.",
+            "# TYPE tgm_export_api_retries gauge",
+            f"tgm_export_api_retries {summary['api']['retries']}",
+        ]
+        try:
+            # The collector may read at any moment, so the file is replaced in one step
+            path = Path(textfile).expanduser()
+            tmp_path = path.with_name(path.name + ".tmp")
+            tmp_path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+            os.replace(tmp_path, path)
+        except Exception as e:  # noqa: BLE001
+            print(f"Failed to write metrics textfile {textfile}: {e}")
+
+
+def link_or_copy(src: Path, dst: Path) -> None:
+    if dst.exists():
+        return
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with path.open("rb") as fh:
+        for chunk in iter(lambda: fh.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def media_store_key(media: Any) -> Optional[str]:
+    if isinstance(media, Photo):
+        return f"photo_{media.id}"
+    if isinstance(media, Document):
+        return f"document_{media.id}"
+    return None
+
+
+class MediaStore:
+    # Shared across runs: objects/<hh>/<sha256><ext>, with index.json mapping Telegram
+    # photo/document ids to objects. Runs hardlink objects into their media/ folder,
+    # so an object's link count doubles as its reference count. Entries added since the
+    # last save are appended to index.log so an interrupted run does not lose them;
+    # partial downloads stay in tmp/ under a stable name and are resumed.
+    def __init__(self, root: Path) -> None:
+        self.root = root
+        self.tmp_dir = root / "tmp"
+        self.tmp_dir.mkdir(parents=True, exist_ok=True)
+        self._index_path = root / "index.json"
+        self._log_path = root / "index.log"
+        self._index: dict[str, str] = {}
+        self._inflight: dict[str, asyncio.Future] = {}
+        try:
+            self._index = json.loads(self._index_path.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            pass
+        except Exception as e:  # noqa: BLE001
+            print(f"Ignoring unreadable media store index: {e}")
+        for rec in read_jsonl(self._log_path):
+            self._index[rec["key"]] = rec["rel"]
+        self._log = self._log_path.open("a", encoding="utf-8")
+
+    def lookup(self, key: Optional[str]) -> Optional[Path]:
+        rel = self._index.get(key) if key else None
+        if rel and (self.root / rel).exists():
+            return self.root / rel
+        return None
+
+    async def fetch(self, key: str, ext: str, download: Callable[[Path], Awaitable[Any]]) -> Optional[Path]:
+        obj = self.lookup(key)
+        if obj:
+            return obj
+        # The same document may show up in several messages at once; download it only once
+        # Every caller gets the outcome of the shared download, errors included, and handles it itself
+        inflight = self._inflight.get(key)
+        if inflight:
+            try:
+                return await asyncio.shield(inflight)
+            except asyncio.CancelledError:
+                if not inflight.cancelled():
+                    raise
+            # Only the task that was downloading it was cancelled; this one starts over
+            return await self.fetch(key, ext, download)
+        fut: asyncio.Future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        try:
+            obj = await self._download(key, ext, download)
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except BaseException as e:
+            fut.set_exception(e)
+            # Retrieved here, so asyncio does not report it when nobody was waiting
+            fut.exception()
+            raise
+        else:
+            fut.set_result(obj)
+            return obj
+        finally:
+            del self._inflight[key]
+
+    async def _download(self, key: str, ext: str, download: Callable[[Path], Awaitable[Any]]) -> Optional[Path]:
+        downloaded = await download(self.tmp_dir / (key + ext))
+        if not downloaded:
+            return None
+        tmp_path = Path(downloaded)
+        digest = await asyncio.to_thread(file_sha256, tmp_path)
+        rel = f"objects/{digest[:2]}/{digest}{tmp_path.suffix}"
+        obj = self.root / rel
+        obj.parent.mkdir(parents=True, exist_ok=True)
+        if obj.exists():
+            # Same bytes under a different Telegram id
+            tmp_path.unlink()
+        else:
+            os.replace(tmp_path, obj)
+        self._index[key] = rel
+        self._log.write(json.dumps({"key": key, "rel": rel}) + "\n")
+        self._log.flush()
+        return obj
+
+    def evict(self, paths: list[Path]) -> None:
+        # Run files found damaged on --resume: the object they are hardlinks of has the same bytes
+        # and is dropped, so the file is downloaded again instead of linked
+        damaged = {(st.st_dev, st.st_ino) for st in (path.stat() for path in paths) if st.st_nlink > 1}
+        if not damaged:
+            return
+        for obj in [*(self.root / "objects").glob("*/*"), *(self.root / DERIVED_DIR).glob("*/*")]:
+            st = obj.stat()
+            if (st.st_dev, st.st_ino) in damaged:
+                obj.unlink()
+        self._index = {k: rel for k, rel in self._index.items() if (self.root / rel).exists()}
+
+    def save(self) -> None:
+        tmp_path = self.root / "index.json.tmp"
+        tmp_path.write_text(json.dumps(self._index), encoding="utf-8")
+        os.replace(tmp_path, self._index_path)
+        self._log.truncate(0)
+        self._log.seek(0)
+
+    def gc(self) -> int:
+        removed = 0
+        digests = set()
+        for obj in (self.root / "objects").glob("*/*"):
+            try:
+                # Only the store itself still links to it
+                if obj.stat().st_nlink <= 1:
+                    obj.unlink()
+                    removed += 1
+                else:
+                    digests.add(obj.stem)
+            except OSError as e:
+                print(f"Failed to remove {obj}: {e}")
+        for obj in (self.root / DERIVED_DIR).glob("*/*"):
+            try:
+                # A "nothing to make" marker goes with its source object
+                unused = obj.name.split("_")[0] not in digests if obj.suffix == ".none" else obj.stat().st_nlink <= 1
+                if unused:
+                    obj.unlink()
+            except OSError as e:
+                print(f"Failed to remove {obj}: {e}")
+        self._index = {k: rel for k, rel in self._index.items() if (self.root / rel).exists()}
+        self.save()
+        return removed
+
+
+# --derivatives live in the media store under derived/<hh>/<source sha256>_<kind>_v<version><suffix>
+DERIVED_DIR = "derived"
+# Bumped whenever a recipe below changes, so cached derivatives are made again
+DERIVATIVE_VERSION = 1
+DERIVATIVE_SUFFIXES = {"web": ".webp", "poster": ".jpg", "waveform": ".svg"}
+# Images that get a web copy; GIFs would lose their animation
+WEB_IMAGE_TYPES = ("image/jpeg", "image/png", "image/webp", "image/bmp", "image/tiff")
+WEB_IMAGE_SIDE = 1280
+WEB_IMAGE_QUALITY = 80
+# Images within WEB_IMAGE_SIDE and below this size are shown as they are
+WEB_IMAGE_MIN_BYTES = 256 * 1024
+POSTER_SIDE = 960
+WAVEFORM_BARS = 64
+WAVEFORM_HEIGHT = 28
+DERIVATIVE_TIMEOUT = 120
+
+
+def _web_image(source: Path, target: Path, waveform: Optional[bytes]) -> bool:
+    with Image.open(source) as image:
+        if max(image.size) <= WEB_IMAGE_SIDE and source.stat().st_size <= WEB_IMAGE_MIN_BYTES:
+            return False
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((WEB_IMAGE_SIDE, WEB_IMAGE_SIDE))
+        image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+        image.save(target, "WEBP", quality=WEB_IMAGE_QUALITY, method=4)
+    # A copy that is not smaller is of no use
+    return target.stat().st_size < source.stat().st_size
+
+
+def _poster_frame(source: Path, target: Path, waveform: Optional[bytes]) -> bool:
+    # The very first frame is often black; short clips fall back to it
+    for seek in ("1", "0"):
+        subprocess.run(
+            ["ffmpeg", "-v", "error", "-y", "-ss", seek, "-i", str(source), "-frames:v", "1",
+             "-vf", f"scale='min({POSTER_SIDE},iw)':-2", "-q:v", "4", str(target)],
+            check=True, capture_output=True, timeout=DERIVATIVE_TIMEOUT,
+        )
+        if target.exists() and target.stat().st_size:
+            return True
+    return False
+
+
+def _waveform_svg(source: Path, target: Path, waveform: Optional[bytes]) -> bool:
+    if waveform:
+        # Telegram's own 5-bit levels of the voice note
+        levels: Any = tl_utils.decode_waveform(waveform)
+    else:
+        pcm = subprocess.run(
+            ["ffmpeg", "-v", "error", "-i", str(source), "-ac", "1", "-ar", "8000", "-f", "s16le", "-"],
+            check=True, capture_output=True, timeout=DERIVATIVE_TIMEOUT,
+        ).stdout
+        levels = array.array("h", pcm[:len(pcm) // 2 * 2])
+        if sys.byteorder == "big":
+            levels.byteswap()
+    if not levels:
+        return False
+    step = len(levels) / WAVEFORM_BARS
+    bars = [max(abs(v) for v in levels[int(i * step):max(int((i + 1) * step), int(i * step) + 1)]) for i in range(WAVEFORM_BARS)]
+    top = max(bars) or 1
+    rects = "".join(
+        f'<rect x="{i * 3}" y="{(WAVEFORM_HEIGHT - h) / 2}" width="2" height="{h}" rx="1"/>'
+        for i, h in enumerate(max(2, round(bar / top * WAVEFORM_HEIGHT)) for bar in bars)
+    )
+    target.write_text(
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{WAVEFORM_BARS * 3}" height="{WAVEFORM_HEIGHT}" fill="#6fa8ff">{rects}</svg>',
+        encoding="utf-8",
+    )
+    return True
+
+
+DERIVATIVE_MAKERS = {"web": _web_image, "poster": _poster_frame, "waveform": _waveform_svg}
+
+
+def make_derivative(kind: str, source: str, digest: Optional[str], out_dir: str, waveform: Optional[bytes]) -> Tuple[Optional[str], bool, float]:
+    # Runs in a derivative worker process. Returns the cached file (None when the source is
+    # best shown as it is or could not be converted, which is cached as well), whether it was
+    # made just now and the seconds spent, which go to the "derivatives" phase
+    started = time.perf_counter()
+    digest = digest or file_sha256(Path(source))
+    target = Path(out_dir) / digest[:2] / f"{digest}_{kind}_v{DERIVATIVE_VERSION}{DERIVATIVE_SUFFIXES[kind]}"
+    marker = target.with_name(target.name + ".none")
+    if target.exists() or marker.exists():
+        return (str(target) if target.exists() else None), False, time.perf_counter() - started
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = target.with_name(f"{target.stem}.{os.getpid()}.tmp{target.suffix}")
+    try:
+        made = DERIVATIVE_MAKERS[kind](Path(source), tmp_path, waveform)
+        if made:
+            os.replace(tmp_path, target)
+        else:
+            marker.touch()
+    except Exception as e:
+        # A source that fails once fails every time; the marker keeps it from being sent again
+        marker.write_text(f"{type(e).__name__}: {e}\n", encoding="utf-8")
+        raise
+    finally:
+        tmp_path.unlink(missing_ok=True)
+    return (str(target) if made else None), True, time.perf_counter() - started
+
+
+class Derivatives:
+    # --derivatives: web-sized copies of images, poster frames of videos and waveforms of voice
+    # notes, made in worker processes while downloads go on. They are kept in the media store
+    # by the source's SHA-256, so no file is processed twice, in this run or a later one.
+    def __init__(self, store: MediaStore, processes: int, metrics: Metrics) -> None:
+        self.dir = store.root / DERIVED_DIR
+        self.metrics = metrics
+        self.kinds = {"waveform"}
+        if Image is not None:
+            self.kinds.add("web")
+        else:
+            print("Pillow is not installed; images are shown as they are.")
+        self._inflight: dict[Tuple[str, str], asyncio.Future] = {}
+        self.ffmpeg = shutil.which("ffmpeg") is not None
+        if self.ffmpeg:
+            self.kinds.add("poster")
+        else:
+            print("ffmpeg was not found; videos get no poster frames.")
+        self._executor = ProcessPoolExecutor(max(1, processes), mp_context=multiprocessing.get_context("spawn"))
+
+    def kind_for(self, mimetype: Optional[str], audio: Optional[DocumentAttributeAudio]) -> Optional[str]:
+        mime = mimetype or ""
+        if mime in WEB_IMAGE_TYPES and "web" in self.kinds:
+            return "web"
+        if mime.startswith("video/") and "poster" in self.kinds:
+            return "poster"
+        # Voice notes usually come with their levels; others need ffmpeg to decode them
+        if audio is not None and audio.voice and (audio.waveform or self.ffmpeg):
+            return "waveform"
+        return None
+
+    async def make(self, kind: str, source: Path, digest: Optional[str], waveform: Optional[bytes]) -> Optional[Path]:
+        # Messages sharing a file wait for the one that is already processing it
+        inflight = self._inflight.get((digest, kind)) if digest else None
+        if inflight:
+            return await asyncio.shield(inflight)
+        loop = asyncio.get_running_loop()
+        fut = loop.run_in_executor(self._executor, make_derivative, kind, str(source), digest, str(self.dir), waveform)
+        result = loop.create_future()
+        if digest:
+            self._inflight[(digest, kind)] = result
+        try:
+            made, fresh, seconds = await fut
+            self.metrics.add("derivatives", seconds)
+            self.metrics.count("derivatives_made" if fresh else "derivatives_cached")
+            result.set_result(Path(made) if made else None)
+            return result.result()
+        except BaseException:
+            result.set_result(None)
+            raise
+        finally:
+            self._inflight.pop((digest, kind), None)
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+
+def edit_timestamp(message: Message) -> int:
+    edit_date = getattr(message, "edit_date", None)
+    return int(edit_date.timestamp()) if edit_date else 0
+
+
 def format_dt(dt: datetime) -> str:
     return dt.strftime("%Y-%m-%d %H:%M:%S %Z")
 
@@ -110,71 +931,427 @@ def linkify_text(escaped_text: str) -> str:
     return _URL_RE.sub(_repl, escaped_text)
 
 
-CUSTOM_TRANSLATIONS: dict[str, str] = {}
+# The --lang-file table of the export being rendered; concurrent --targets exports each set their own
+CUSTOM_TRANSLATIONS: ContextVar[dict[str, str]] = ContextVar("custom_translations", default={})
 
 
 def t(lang: str, key: str) -> str:
-    if key in CUSTOM_TRANSLATIONS:
-        return CUSTOM_TRANSLATIONS[key]
+    custom = CUSTOM_TRANSLATIONS.get()
+    if key in custom:
+        return custom[key]
     ru = {
         "title_base": "Сохранённые сообщения Telegram",
         "title_of": "Сохранённые сообщения Telegram пользователя {id}",
+        "title_chat": "Telegram-чат «{name}»",
         "exported_at": "Экспорт выполнен {when} | Всего сообщений: {count}",
         "forwarded_from": "Переслано от {source}",
+        "original_skipped": "оригинал не скачан",
         "media_skipped": "медиа пропущено (>{limit} байт)",
         "media_not_downloaded": "медиа не скачано (dry-run)",
         "transcription": "Транскрипция",
         "progress": "Экспорт сообщений: {done} / {total}",
         "progress_no_total": "Экспорт сообщений: {done}",
+        "prev_page": "← Назад",
+        "next_page": "Вперёд →",
+        "all_pages": "Все страницы",
+        "page_count": "сообщений: {count}",
+        "search_placeholder": "Поиск по сообщениям",
+        "search_found": "Найдено: {count}",
+        "search_none": "Ничего не найдено",
     }
     en = {
         "title_base": "Telegram Saved Messages",
         "title_of": "Telegram Saved Messages of {id}",
+        "title_chat": "Telegram chat: {name}",
         "exported_at": "Exported at {when} | Total messages: {count}",
         "forwarded_from": "Forwarded from {source}",
+        "original_skipped": "original not downloaded",
         "media_skipped": "media skipped (>{limit} bytes)",
         "media_not_downloaded": "media not downloaded (dry-run)",
         "transcription": "Transcription",
         "progress": "Exporting messages: {done} / {total}",
         "progress_no_total": "Exporting messages: {done}",
+        "prev_page": "← Previous",
+        "next_page": "Next →",
+        "all_pages": "All pages",
+        "page_count": "{count} messages",
+        "search_placeholder": "Search messages",
+        "search_found": "{count} found",
+        "search_none": "No matches",
     }
     table = ru if lang == "ru" else en
     return table.get(key, key)
 
 
+def load_custom_translations(path: str) -> None:
+    translations: dict[str, str] = {}
+    if path:
+        try:
+            translations = json.loads(Path(path).read_text(encoding="utf-8"))
+            if not isinstance(translations, dict):
+                translations = {}
+        except Exception as e:  # noqa: BLE001
+            print(f"Failed to load language file {path}: {e}")
+    CUSTOM_TRANSLATIONS.set(translations)
+
+
+def build_export_title(lang: str, phone_display: Optional[str], username: Optional[str], chat: Optional[str] = None) -> str:
+    if chat:
+        return t(lang, "title_chat").format(name=chat)
+    if lang == "ru":
+        if phone_display and username:
+            return f"Сохранённые сообщения Telegram пользователя {phone_display} ({username})"
+        elif phone_display:
+            return f"Сохранённые сообщения Telegram пользователя {phone_display}"
+        elif username:
+            return f"Сохранённые сообщения Telegram пользователя {username}"
+        return t(lang, "title_base")
+    if phone_display and username:
+        return f"Telegram Saved Messages of {phone_display} ({username})"
+    elif phone_display:
+        return f"Telegram Saved Messages of {phone_display}"
+    elif username:
+        return f"Telegram Saved Messages of {username}"
+    return t(lang, "title_base")
+
+
 def format_ui_datetime(lang: str, dt_utc: datetime) -> str:
     local = dt_utc.astimezone()
     if lang == "ru":
         return local.strftime("%d.%m.%Y %H:%M:%S %Z")
     return local.strftime("%Y-%m-%d %H:%M:%S %Z")
 
-async def render_forwarded_from(client: TelegramClient, message: Message) -> Optional[str]:
+class HtmlWriter:
+    # Header, blocks and footer go straight to a buffered file; the message count is
+    # only known at the end, so a blank slot in the header is patched in place on close
+    COUNT_SLOT_WIDTH = 12
+
+    def __init__(self, path: Path, title: str, lang: str, head_html: str = "", nav_html: str = "", search: bool = False) -> None:
+        self.path = path
+        self._nav_html = nav_html
+        self._fh = path.open("wb", buffering=1 << 16)
+        self._count_offset: Optional[int] = None
+        marker = "\x00count\x00"
+        meta = html.escape(t(lang, "exported_at").format(when=format_ui_datetime(lang, datetime.now(timezone.utc)), count=marker))
+        meta_before, has_count, meta_after = meta.partition(marker)
+        search_html = ""
+        if search:
+            head_html += f"<script>{SEARCH_JS}</script>\n"
+            search_html = (
+                f'<div class="search" data-found="{html.escape(t(lang, "search_found"))}" data-none="{html.escape(t(lang, "search_none"))}">'
+                f'<input type="search" placeholder="{html.escape(t(lang, "search_placeholder"))}"/><div class="search-results"></div></div>\n'
+            )
+        self._write(
+            "<!DOCTYPE html>\n"
+            "<html lang=\"en\">\n<head>\n<meta charset=\"utf-8\">\n"
+            f"<title>{html.escape(title)}</title>\n<style>{CSS_STYLE}</style>\n{head_html}"
+            "</head>\n<body>\n"
+            "<div class=\"header\">\n"
+            f"  <h1 class=\"title\">{html.escape(title)}</h1>\n"
+            f"  <div class=\"meta\">{meta_before}"
+        )
+        if has_count:
+            self._count_offset = self._fh.tell()
+            self._write(" " * self.COUNT_SLOT_WIDTH)
+        self._write(f"{meta_after}</div>\n{search_html}{nav_html}</div>\n<div class=\"container\">\n")
+
+    def _write(self, text: str) -> None:
+        self._fh.write(text.encode("utf-8"))
+
+    def write_block(self, msg_id: int, date_iso: str, block: str) -> None:
+        self._write(block + "\n")
+
+    def close(self, count: int) -> None:
+        if self._fh.closed:
+            return
+        self._write(f"</div>\n{self._nav_html}</body>\n</html>\n")
+        if self._count_offset is not None:
+            self._fh.seek(self._count_offset)
+            self._write(str(count).ljust(self.COUNT_SLOT_WIDTH)[:self.COUNT_SLOT_WIDTH])
+        self._fh.close()
+
+
+class ShardedHtmlWriter:
+    # One page per UTC month plus a small index.html. Months are stable, so an
+    # incremental run copies every page whose month saw no new or edited messages
+    # from the previous run instead of rewriting it.
+    def __init__(self, run_dir: Path, title: str, lang: str, dirty_months: set[str], reuse_dir: Optional[Path] = None, search: bool = False) -> None:
+        self.path = run_dir / "index.html"
+        self._search = search
+        self._run_dir = run_dir
+        self._title = title
+        self._lang = lang
+        self._dirty_months = dirty_months
+        self._reuse_dir = reuse_dir
+        self._pages: list[dict[str, Any]] = []
+        self._page_writer: Optional[HtmlWriter] = None
+        self._closed = False
+
+    def write_block(self, msg_id: int, date_iso: str, block: str) -> None:
+        month = date_iso[:7]
+        page = self._pages[-1] if self._pages else None
+        if page is None or page["month"] != month:
+            self._close_page()
+            page = self._open_page(month)
+        page["count"] += 1
+        page["min"] = min(page["min"], msg_id)
+        page["max"] = max(page["max"], msg_id)
+        if self._page_writer:
+            self._page_writer.write_block(msg_id, date_iso, block)
+
+    def _open_page(self, month: str) -> dict[str, Any]:
+        # Guard against a month showing up twice (out-of-order dates) by numbering the repeat
+        repeats = sum(1 for p in self._pages if p["month"] == month)
+        file_name = f"page_{month}.html" if not repeats else f"page_{month}_{repeats + 1}.html"
+        page: dict[str, Any] = {"file": file_name, "month": month, "count": 0, "min": float("inf"), "max": 0}
+        self._pages.append(page)
+        prev_page = self._reuse_dir / file_name if self._reuse_dir else None
+        if prev_page and prev_page.exists() and month not in self._dirty_months:
+            link_or_copy(prev_page, self._run_dir / file_name)
+            self._page_writer = None
+        else:
+            self._page_writer = self.page_writer(file_name, month)
+        return page
+
+    def page_writer(self, file_name: str, month: str) -> HtmlWriter:
+        return HtmlWriter(
+            self._run_dir / file_name,
+            f"{self._title} — {month}",
+            self._lang,
+            head_html=self._head_html(),
+            nav_html=self._nav_html(),
+            search=self._search,
+        )
+
+    def _close_page(self) -> None:
+        if self._page_writer and self._pages:
+            self._page_writer.close(self._pages[-1]["count"])
+        self._page_writer = None
+
+    def _head_html(self) -> str:
+        return f'<script src="pages.js"></script>\n<script>{SHARD_NAV_JS}</script>\n'
+
+    def _nav_html(self) -> str:
+        return (
+            '<div class="nav">'
+            f'<a data-nav="prev">{html.escape(t(self._lang, "prev_page"))}</a>'
+            f'<a href="index.html">{html.escape(t(self._lang, "all_pages"))}</a>'
+            f'<a data-nav="next">{html.escape(t(self._lang, "next_page"))}</a>'
+            "</div>\n"
+        )
+
+    def close(self, count: int) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        self._close_page()
+        self.write_index([{"file": p["file"], "month": p["month"], "count": p["count"], "min": p["min"], "max": p["max"]} for p in self._pages if p["count"]], count)
+
+    def write_index(self, pages: list[dict[str, Any]], count: int) -> None:
+        (self._run_dir / "pages.js").write_text(f"window.EXPORT_PAGES = {json.dumps(pages)};\n", encoding="utf-8")
+        index = HtmlWriter(self.path, self._title, self._lang, head_html=self._head_html(), search=self._search)
+        for p in pages:
+            index.write_block(0, "", (
+                f'<div class="page-link"><a href="{html.escape(p["file"])}">{html.escape(p["month"])}</a>'
+                f'<span class="badge">{html.escape(t(self._lang, "page_count").format(count=p["count"]))}</span></div>'
+            ))
+        index.close(count)
+
+
+def load_pages(run_dir: Path) -> list[dict[str, Any]]:
+    # The page list a ShardedHtmlWriter left in pages.js
+    text = (run_dir / "pages.js").read_text(encoding="utf-8")
+    return json.loads(text.partition("=")[2].strip().rstrip(";"))
+
+
+def splice_page(src: Path, writer: HtmlWriter, updates: dict[int, dict], lang: str, reverse: bool) -> int:
+    # Copies the blocks of a page HtmlWriter wrote into writer without rendering them again, with
+    # the blocks of updated messages replaced and new messages slotted in by id. A block spans
+    # several lines only when a transcript or link preview has line breaks; escaped text can
+    # neither start a line with the block prefix nor be the bare </div> closing the container.
+    # Returns the number of blocks written.
+    prefix = b'<div class="message" id="msg-'
+
+    def _key(msg_id: int) -> int:
+        return msg_id if reverse else -msg_id
+
+    def _blocks() -> Iterator[Tuple[int, bytes]]:
+        if not src.exists():
+            return
+        with src.open("rb") as fh:
+            for line in fh:
+                if line == b'<div class="container">\n':
+                    break
+            else:
+                raise ValueError(f"{src.name} has no message container")
+            msg_id, lines = 0, []
+            for line in fh:
+                if line.startswith(prefix) or line == b"</div>\n":
+                    if lines:
+                        yield msg_id, b"".join(lines)
+                    if not line.startswith(prefix):
+                        return
+                    msg_id, lines = int(line[len(prefix):line.index(b'"', len(prefix))]), [line]
+                elif lines:
+                    lines.append(line)
+        raise ValueError(f"{src.name} ends inside its message container")
+
+    def _write(rec: dict) -> None:
+        writer.write_block(int(rec["id"]), rec["date"], render_record(rec, lang))
+
+    pending = sorted(updates, key=_key)
+    i = count = 0
+    for msg_id, block in _blocks():
+        while i < len(pending) and _key(pending[i]) < _key(msg_id):
+            _write(updates[pending[i]])
+            i += 1
+            count += 1
+        if i < len(pending) and pending[i] == msg_id:
+            _write(updates[msg_id])
+            i += 1
+        else:
+            writer.write_block(msg_id, "", block.decode("utf-8")[:-1])
+        count += 1
+    for msg_id in pending[i:]:
+        _write(updates[msg_id])
+        count += 1
+    return count
+
+
+# Forwarded-from lookups within this window are resolved with a single request
+ENTITY_BATCH_DELAY = 0.05
+ENTITY_BATCH_SIZE = 100
+
+
+class EntityCache:
+    # entities.json in the output directory, held in memory for the run. Entries expire after
+    # the TTL and expired ones are dropped on load and save; peers that could not be resolved
+    # are cached too so they are not retried.
+    def __init__(self, client: TelegramClient, path: Path, ttl_seconds: float, metrics: Metrics) -> None:
+        self._client = client
+        self._metrics = metrics
+        self._path = path
+        self._ttl = ttl_seconds
+        self._disk: dict[str, dict] = {}
+        self._pending: dict[int, Tuple[Any, asyncio.Future]] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        try:
+            self._disk = self._unexpired(json.loads(path.read_text(encoding="utf-8")))
+        except FileNotFoundError:
+            pass
+        except Exception as e:  # noqa: BLE001
+            print(f"Ignoring unreadable entity cache: {e}")
+
+    def _unexpired(self, entries: dict[str, dict]) -> dict[str, dict]:
+        now = time.time()
+        return {key: entry for key, entry in entries.items() if now - entry.get("ts", 0) <= self._ttl}
+
+    def _lookup(self, key: int) -> Optional[dict]:
+        entry = self._disk.get(str(key))
+        if entry is None or time.time() - entry.get("ts", 0) > self._ttl:
+            return None
+        return entry
+
+    def _remember(self, key: int, entry: dict) -> None:
+        self._disk[str(key)] = entry
+
+    async def resolve(self, peer: Any) -> Optional[dict]:
+        key = tl_utils.get_peer_id(peer)
+        entry = self._lookup(key)
+        if entry is not None:
+            return entry if entry.get("name") else None
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = (peer, asyncio.get_running_loop().create_future())
+            self._pending[key] = pending
+            if self._flush_task is None or self._flush_task.done():
+                self._flush_task = asyncio.create_task(self._flush())
+        entry = await asyncio.shield(pending[1])
+        return entry if entry.get("name") else None
+
+    async def _flush(self) -> None:
+        await asyncio.sleep(ENTITY_BATCH_DELAY)
+        while self._pending:
+            batch = list(self._pending.items())[:ENTITY_BATCH_SIZE]
+            peers = [peer for _, (peer, _) in batch]
+            self._metrics.count("entity_lookups", len(peers))
+            with self._metrics.phase("entities"):
+                try:
+                    entities = await self._client.get_entity(peers)
+                except Exception:
+                    # One bad peer fails the whole batch; fall back to resolving them one by one
+                    entities = []
+                    for peer in peers:
+                        try:
+                            entities.append(await self._client.get_entity(peer))
+                        except Exception:
+                            entities.append(None)
+            for (key, (_, fut)), ent in zip(batch, entities):
+                entry = {"name": entity_display_name(ent) if ent else None, "username": getattr(ent, "username", None), "ts": time.time()}
+                self._remember(key, entry)
+                del self._pending[key]
+                if not fut.done():
+                    fut.set_result(entry)
+
+    def save(self) -> None:
+        try:
+            tmp_path = self._path.with_name(self._path.name + ".tmp")
+            self._disk = self._unexpired(self._disk)
+            tmp_path.write_text(json.dumps(self._disk), encoding="utf-8")
+            os.replace(tmp_path, self._path)
+        except Exception as e:  # noqa: BLE001
+            print(f"Failed to save entity cache: {e}")
+
+
+def entity_display_name(ent: Any) -> Optional[str]:
+    title = getattr(ent, "title", None)
+    first_name = getattr(ent, "first_name", None)
+    last_name = getattr(ent, "last_name", None)
+    return title or (" ".join([n for n in [first_name, last_name] if n]) or None)
+
+
+async def resolve_forward(entities: EntityCache, message: Message) -> Optional[dict]:
     fwd = getattr(message, "fwd_from", None)
     if not fwd:
         return None
-    # Prefer explicit from_name if present
-    name = getattr(fwd, "from_name", None)
-    if name:
-        return html.escape(name)
     # Try from_id or saved_from_peer
     peer = getattr(fwd, "from_id", None) or getattr(fwd, "saved_from_peer", None)
+    fwd_date = getattr(fwd, "date", None)
+    info: dict[str, Any] = {
+        "from_id": None,
+        "from_name": getattr(fwd, "from_name", None),
+        "date": fwd_date.isoformat() if fwd_date else None,
+        "name": None,
+        "username": None,
+    }
     if not peer:
-        return None
+        return info
     try:
-        ent = await client.get_entity(peer)
-        title = getattr(ent, "title", None)
-        first_name = getattr(ent, "first_name", None)
-        last_name = getattr(ent, "last_name", None)
-        username = getattr(ent, "username", None)
-        display = title or (" ".join([n for n in [first_name, last_name] if n]) or None)
-        if not display:
-            return None
-        display = html.escape(display)
-        if username:
-            return f'<a href="https://t.me/{html.escape(username)}" target="_blank" rel="noopener noreferrer">{display}</a>'
-        return display
+        info["from_id"] = tl_utils.get_peer_id(peer)
+        # An explicit from_name wins, so there is nothing to look up
+        if not info["from_name"]:
+            entry = await entities.resolve(peer)
+            if entry:
+                info["name"] = entry["name"]
+                info["username"] = entry.get("username")
     except Exception:
+        pass
+    return info
+
+
+def render_forwarded_from(fwd: Optional[dict]) -> Optional[str]:
+    if not fwd:
+        return None
+    # Prefer explicit from_name if present
+    if fwd.get("from_name"):
+        return html.escape(fwd["from_name"])
+    if not fwd.get("name"):
         return None
+    display = html.escape(fwd["name"])
+    username = fwd.get("username")
+    if username:
+        return f'<a href="https://t.me/{html.escape(username)}" target="_blank" rel="noopener noreferrer">{display}</a>'
+    return display
 
 
 def detect_extension(message: Message) -> str:
@@ -196,19 +1373,270 @@ def detect_extension(message: Message) -> str:
     return ""
 
 
-def decide_media_tag(rel_path: str, mimetype: Optional[str]) -> str:
+# --thumbnail-first shows the largest server-side thumbnail up to this many pixels per side
+THUMB_MAX_SIDE = 800
+
+
+def pick_thumbnail(media: Any) -> Optional[Any]:
+    # A server-side size clearly smaller than the original, or None when there is none
+    if isinstance(media, Photo):
+        sizes = media.sizes or []
+    elif isinstance(media, Document):
+        sizes = media.thumbs or []
+    else:
+        return None
+    candidates = [size for size in sizes if isinstance(size, (PhotoSize, PhotoSizeProgressive, PhotoCachedSize))]
+    if not candidates:
+        return None
+    fitting = [size for size in candidates if max(size.w, size.h) <= THUMB_MAX_SIDE]
+    thumb = max(fitting, key=lambda size: size.w * size.h) if fitting else min(candidates, key=lambda size: size.w * size.h)
+    # The largest size of a photo is the original itself
+    if isinstance(media, Photo) and thumb.w * thumb.h >= max(size.w * size.h for size in candidates):
+        return None
+    return thumb
+
+
+def original_size(media: Any) -> int:
+    if isinstance(media, Document):
+        return media.size or 0
+    sizes = [size for size in getattr(media, "sizes", None) or [] if isinstance(size, (PhotoSize, PhotoSizeProgressive))]
+    if not sizes:
+        return 0
+    largest = max(sizes, key=lambda size: size.w * size.h)
+    return max(largest.sizes) if isinstance(largest, PhotoSizeProgressive) else largest.size
+
+
+def wants_original(args: argparse.Namespace, mimetype: Optional[str], size: int) -> bool:
+    if args.originals_max_bytes and size > args.originals_max_bytes:
+        return False
+    patterns = [p.strip() for p in args.originals.split(",") if p.strip()]
+    return any(fnmatch.fnmatch(mimetype or "", pattern) for pattern in patterns)
+
+
+def decide_media_tag(rel_path: str, mimetype: Optional[str], derived: Optional[dict] = None) -> str:
+    derived = derived or {}
     if mimetype:
         if mimetype.startswith("image/"):
+            if derived.get("web"):
+                # The web copy links to the full-size original
+                return (
+                    f'<a href="{html.escape(rel_path)}" target="_blank">'
+                    f'<img class="media-img" src="{html.escape(derived["web"])}" loading="lazy" alt="image" /></a>'
+                )
             return f'<img class="media-img" src="{html.escape(rel_path)}" loading="lazy" alt="image" />'
         if mimetype.startswith("video/"):
+            if derived.get("poster"):
+                # With a poster to show, nothing of the video is loaded until it is played
+                return f'<video class="media-vid" src="{html.escape(rel_path)}" poster="{html.escape(derived["poster"])}" controls preload="none"></video>'
             return f'<video class="media-vid" src="{html.escape(rel_path)}" controls preload="metadata"></video>'
         if mimetype.startswith("audio/"):
-            return f'<audio class="media-aud" src="{html.escape(rel_path)}" controls preload="metadata"></audio>'
+            wave_html = f'<img class="media-wave" src="{html.escape(derived["waveform"])}" alt="" />' if derived.get("waveform") else ""
+            return f'{wave_html}<audio class="media-aud" src="{html.escape(rel_path)}" controls preload="metadata"></audio>'
     # default: downloadable link
     file_name = os.path.basename(rel_path)
     return f'<a class="file-link" href="{html.escape(rel_path)}" download>{html.escape(file_name)}</a>'
 
 
+async def count_messages(client: TelegramClient, peer: Any, since_dt: Optional[datetime], until_dt_exclusive: Optional[datetime]) -> Optional[int]:
+    # GetHistory reports the history size in .count and, started at a date, how many
+    # messages are newer than that date in .offset_id_offset
+    async def history(offset_date: Optional[datetime]) -> Any:
+        return await client(tl_functions.messages.GetHistoryRequest(
+            peer=peer,
+            offset_id=0,
+            offset_date=offset_date,
+            add_offset=0,
+            limit=1,
+            max_id=0,
+            min_id=0,
+            hash=0,
+        ))
+
+    try:
+        if not since_dt and not until_dt_exclusive:
+            result = await history(None)
+            # A plain messages.Messages answer means the whole history fitted in it
+            return getattr(result, "count", None) if hasattr(result, "count") else len(getattr(result, "messages", []))
+        newer_than_until = 0
+        if until_dt_exclusive:
+            newer_than_until = getattr(await history(until_dt_exclusive), "offset_id_offset", None)
+        if since_dt:
+            newer_than_since = getattr(await history(since_dt), "offset_id_offset", None)
+        else:
+            newer_than_since = getattr(await history(None), "count", None)
+        if newer_than_since is None or newer_than_until is None:
+            return None
+        return max(0, newer_than_since - newer_than_until)
+    except Exception as e:  # noqa: BLE001
+        print(f"Could not count the messages for the progress bar: {e}")
+        return None
+
+
+# Per request class: (starting/maximum requests per second, burst size). A class is halved on
+# every FloodWait and creeps back towards its maximum while requests keep succeeding.
+RATE_LIMITS: dict[str, Tuple[float, float]] = {
+    "history": (4.0, 4.0),
+    "download": (40.0, 20.0),
+    "entity": (2.0, 4.0),
+    "transcribe": (1.0, 2.0),
+    "default": (5.0, 5.0),
+}
+RATE_LIMIT_MIN = 0.1
+RATE_LIMIT_RECOVERY = 0.05
+FLOOD_RETRIES = 5
+# FloodPremiumWaitError only exists from Telethon 1.37 on
+_FLOOD_ERRORS = (errors.FloodWaitError, getattr(errors, "FloodPremiumWaitError", errors.FloodWaitError))
+
+_REQUEST_CLASSES: dict[type, str] = {
+    tl_functions.messages.GetHistoryRequest: "history",
+    tl_functions.messages.SearchRequest: "history",
+    tl_functions.messages.GetMessagesRequest: "history",
+    tl_functions.upload.GetFileRequest: "download",
+    tl_functions.upload.GetCdnFileRequest: "download",
+    tl_functions.upload.ReuploadCdnFileRequest: "download",
+    tl_functions.users.GetUsersRequest: "entity",
+    tl_functions.users.GetFullUserRequest: "entity",
+    tl_functions.channels.GetChannelsRequest: "entity",
+    tl_functions.messages.GetChatsRequest: "entity",
+    tl_functions.contacts.ResolveUsernameRequest: "entity",
+    tl_functions.messages.TranscribeAudioRequest: "transcribe",
+}
+
+
+class TokenBucket:
+    def __init__(self, name: str, rate: float, burst: float) -> None:
+        self.name = name
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._blocked_until:
+                    await asyncio.sleep(self._blocked_until - now)
+                    continue
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def penalize(self, seconds: float) -> None:
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+        self.rate = max(RATE_LIMIT_MIN, self.rate / 2)
+        self._tokens = 0
+
+    def reward(self) -> None:
+        self.rate = min(self.max_rate, self.rate + RATE_LIMIT_RECOVERY)
+
+
+# The Metrics of the export a request is made for; tasks inherit it from the export that starts them
+RUN_METRICS: ContextVar[Optional[Metrics]] = ContextVar("run_metrics", default=None)
+
+
+class RateLimiter:
+    def __init__(self) -> None:
+        self.buckets = {name: TokenBucket(name, rate, burst) for name, (rate, burst) in RATE_LIMITS.items()}
+        self.calls: dict[str, int] = {name: 0 for name in RATE_LIMITS}
+        self.flood_waits = 0
+        self.retries = 0
+
+    @staticmethod
+    def classify(request: Any) -> str:
+        if isinstance(request, list):
+            request = request[0] if request else None
+        # Unwrap takeout/without-updates style wrappers
+        while hasattr(request, "query") and isinstance(getattr(request, "query"), TLRequest):
+            request = request.query
+        return _REQUEST_CLASSES.get(type(request), "default")
+
+    async def run(self, request: Any, call: Callable[[], Awaitable[Any]]) -> Any:
+        name = self.classify(request)
+        bucket = self.buckets[name]
+        attempt = 0
+        while True:
+            await bucket.acquire()
+            self.calls[name] += 1
+            metrics = RUN_METRICS.get()
+            if metrics:
+                metrics.api_call(name)
+            try:
+                result = await call()
+            except _FLOOD_ERRORS as e:
+                self.flood_waits += 1
+                if metrics:
+                    metrics.flood_waits += 1
+                bucket.penalize(e.seconds)
+                if attempt >= FLOOD_RETRIES:
+                    raise
+                attempt += 1
+                self.retries += 1
+                if metrics:
+                    metrics.retries += 1
+                if e.seconds >= 10:
+                    print(f"\nFloodWait on {name} requests: pausing them for {e.seconds}s (now {bucket.rate:.2f} req/s)")
+                continue
+            bucket.reward()
+            return result
+
+
+class ExportClient(TelegramClient):
+    # Every request, including file parts fetched by download_media, passes through
+    # _call, so throttling it here covers all call sites at once
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.limiter = RateLimiter()
+        # Surface FloodWaits to the limiter instead of letting Telethon sleep on them
+        self.flood_sleep_threshold = 0
+
+    async def _call(self, sender: Any, request: Any, ordered: bool = False, flood_sleep_threshold: Optional[int] = None) -> Any:
+        # Called unbound because a takeout proxy passes itself as self
+        takeout_id = self.session.takeout_id
+        if takeout_id is not None and isinstance(request, tl_functions.upload.GetFileRequest):
+            # Telethon only wraps __call__ requests in the takeout; file parts go straight to _call
+            request = tl_functions.InvokeWithTakeoutRequest(takeout_id=takeout_id, query=request)
+        return await self.limiter.run(request, lambda: TelegramClient._call(self, sender, request, ordered=ordered, flood_sleep_threshold=flood_sleep_threshold))
+
+
+async def start_takeout(client: TelegramClient, stack: AsyncExitStack, files: bool, max_file_size: Optional[int], label: str = "", **scopes: bool) -> Optional[TelegramClient]:
+    # scopes: chats/megagroups/channels, for anything beyond private chats
+    try:
+        if client.session.takeout_id is not None:
+            # Left over from an interrupted run; only one takeout per session is allowed
+            await client.end_takeout(success=False)
+        takeout = await stack.enter_async_context(client.takeout(
+            finalize=True,
+            users=True,
+            files=files,
+            max_file_size=max_file_size,
+            **scopes,
+        ))
+        print(f"{label}Using a takeout session for the export.")
+        return takeout
+    except errors.TakeoutInitDelayError as e:
+        print(f"{label}Takeout session is waiting for approval in another Telegram app (available in {e.seconds}s); exporting without it.")
+    except Exception as e:  # noqa: BLE001
+        print(f"{label}Takeout session unavailable ({e}); exporting without it.")
+    return None
+
+
+def make_client(args: argparse.Namespace) -> "ExportClient":
+    # Session can be file path or StringSession
+    session_arg: str | StringSession
+    if os.path.exists(args.session):
+        session_arg = args.session
+    else:
+        session_arg = StringSession(args.session) if args.session and len(args.session) > 100 else args.session
+    return ExportClient(session_arg, args.api_id, args.api_hash)
+
+
 async def ensure_login(client: TelegramClient) -> None:
     await client.connect()
     if await client.is_user_authorized():
@@ -230,67 +1658,775 @@ async def transcribe_media_if_needed(local_path: Path, mimetype: Optional[str],
     return None
 
 
-async def transcribe_with_telegram(client: TelegramClient, message: Message) -> Optional[str]:
-    try:
-        me = await client.get_me()
-        is_premium = bool(getattr(me, "premium", False))
-        if not is_premium:
-            return None
-    except Exception:
-        return None
-
+def is_transcribable(message: Message) -> bool:
     # Only voice notes and round video messages are supported
-    is_voice = False
-    is_round_video = False
     if getattr(message, "document", None) and getattr(message.document, "attributes", None):
         for attr in message.document.attributes:
             if isinstance(attr, DocumentAttributeAudio) and getattr(attr, "voice", False):
-                is_voice = True
+                return True
             if isinstance(attr, DocumentAttributeVideo) and getattr(attr, "round_message", False):
-                is_round_video = True
+                return True
+    return False
+
+
+# How long to wait for UpdateTranscribedAudio before asking Telegram again
+TRANSCRIPTION_TIMEOUT = 60
+
+
+class Transcriber:
+    # Telegram's built-in transcription (Premium only). Finished transcripts are cached in
+    # transcripts.json (new ones are appended to transcripts.log until saved) so reruns never
+    # request them again; requests run with bounded concurrency and "pending" results are
+    # completed from UpdateTranscribedAudio.
+    def __init__(self, client: TelegramClient, path: Path, peer: Any, enabled: bool, workers: int, metrics: Metrics) -> None:
+        self._client = client
+        self._peer = peer
+        self._metrics = metrics
+        self._path = path
+        self._log_path = path.with_suffix(".log")
+        self._enabled = enabled
+        self._sem = asyncio.Semaphore(max(1, workers))
+        self._cache: dict[str, str] = {}
+        self._waiting: dict[int, asyncio.Future] = {}
+        self._early: dict[int, str] = {}
+        try:
+            self._cache = json.loads(path.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            pass
+        except Exception as e:  # noqa: BLE001
+            print(f"Ignoring unreadable transcript cache: {e}")
+        for rec in read_jsonl(self._log_path):
+            self._cache[rec["key"]] = rec["text"]
+        self._log = self._log_path.open("a", encoding="utf-8")
+        if enabled:
+            client.add_event_handler(self._on_update, events.Raw(UpdateTranscribedAudio))
+
+    async def _on_update(self, update: UpdateTranscribedAudio) -> None:
+        if update.pending:
+            return
+        fut = self._waiting.get(update.transcription_id)
+        if fut and not fut.done():
+            fut.set_result(update.text)
+        else:
+            # The update can beat the TranscribeAudio response
+            self._early[update.transcription_id] = update.text
 
-    if not (is_voice or is_round_video):
-        return None
+    async def transcribe(self, message: Message) -> Optional[str]:
+        if not self._enabled or not is_transcribable(message):
+            return None
+        key = str(message.id)
+        if key in self._cache:
+            return self._cache[key]
+        try:
+            text = await self._request(message)
+        except Exception as e:  # noqa: BLE001
+            # Silently ignore if Telegram refuses or not supported
+            print(f"Telegram transcription failed for message {message.id}: {e}")
+            return None
+        if text:
+            text = str(text).strip()
+            self._metrics.count("transcripts")
+            self._cache[key] = text
+            self._log.write(json.dumps({"key": key, "text": text}, ensure_ascii=False) + "\n")
+            self._log.flush()
+        return text or None
 
+    async def _request(self, message: Message) -> Optional[str]:
+        request = tl_functions.messages.TranscribeAudioRequest(peer=self._peer, msg_id=message.id)
+        async with self._sem:
+            with self._metrics.phase("transcription"):
+                result = await self._client(request)
+        if not getattr(result, "pending", False):
+            return getattr(result, "text", None)
+        tid = result.transcription_id
+        if tid in self._early:
+            return self._early.pop(tid)
+        fut: asyncio.Future = asyncio.get_running_loop().create_future()
+        self._waiting[tid] = fut
+        try:
+            with self._metrics.phase("transcription"):
+                return await asyncio.wait_for(fut, TRANSCRIPTION_TIMEOUT)
+        except asyncio.TimeoutError:
+            # No update arrived; asking again returns whatever Telegram has by now
+            async with self._sem:
+                with self._metrics.phase("transcription"):
+                    result = await self._client(request)
+            return None if getattr(result, "pending", False) else getattr(result, "text", None)
+        finally:
+            self._waiting.pop(tid, None)
+
+    def save(self) -> None:
+        try:
+            tmp_path = self._path.with_name(self._path.name + ".tmp")
+            tmp_path.write_text(json.dumps(self._cache, ensure_ascii=False), encoding="utf-8")
+            os.replace(tmp_path, self._path)
+            self._log.truncate(0)
+            self._log.seek(0)
+        except Exception as e:  # noqa: BLE001
+            print(f"Failed to save transcript cache: {e}")
+
+    def close(self) -> None:
+        self.save()
+        # The client may outlive this export (--targets)
+        if self._enabled:
+            self._client.remove_event_handler(self._on_update)
+
+
+# Upper bound on messages being enriched (downloads, transcripts) but not yet collected
+RENDER_WINDOW = 2000
+# Messages fetched ahead of enrichment: three pages of history
+HISTORY_PREFETCH = 300
+# Records rendered per call into the render thread/process pool, and batches queued for output
+RENDER_BATCH = 200
+RENDER_QUEUE_BATCHES = 4
+
+
+# Transient failures worth another attempt before a message is rendered without its media
+RETRYABLE_DOWNLOAD_ERRORS = (OSError, asyncio.TimeoutError, errors.ServerError, errors.TimedOutError, errors.FloodError)
+
+
+class DownloadPool:
+    def __init__(self, workers: int, retries: int = 3) -> None:
+        self._retries = retries
+        self.retries = 0
+        self._queues: list[asyncio.Queue] = [asyncio.Queue() for _ in range(max(1, workers))]
+        self._busy = [False] * len(self._queues)
+        self._tasks: list[asyncio.Task] = []
+
+    def start(self) -> None:
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(len(self._queues))]
+
+    async def _worker(self, idx: int) -> None:
+        queue = self._queues[idx]
+        while True:
+            job = await queue.get()
+            if job is None:
+                queue.task_done()
+                return
+            factory, fut = job
+            self._busy[idx] = True
+            try:
+                result = await self._run_with_retries(factory)
+                if not fut.done():
+                    fut.set_result(result)
+            except Exception as e:  # noqa: BLE001
+                if not fut.done():
+                    fut.set_exception(e)
+            finally:
+                self._busy[idx] = False
+                queue.task_done()
+
+    async def _run_with_retries(self, factory: Callable[[], Awaitable[Any]]) -> Any:
+        attempt = 0
+        while True:
+            try:
+                return await factory()
+            except RETRYABLE_DOWNLOAD_ERRORS as e:
+                if attempt >= self._retries:
+                    raise
+                attempt += 1
+                self.retries += 1
+                print(f"\nDownload failed ({e}); retrying in {2 ** attempt}s")
+                await asyncio.sleep(2 ** attempt)
+
+    def submit(self, factory: Callable[[], Awaitable[Any]]) -> "asyncio.Future[Any]":
+        # Hand the job to the least loaded worker so one huge file does not hold up the others
+        idx = min(range(len(self._queues)), key=lambda i: self._queues[i].qsize() + int(self._busy[i]))
+        fut: asyncio.Future = asyncio.get_running_loop().create_future()
+        self._queues[idx].put_nowait((factory, fut))
+        return fut
+
+    async def close(self, cancel: bool = False) -> None:
+        for queue in self._queues:
+            queue.put_nowait(None)
+        if cancel:
+            for task in self._tasks:
+                task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+# Only these are worth deflating; photos, videos and voice notes are already compressed and are stored as-is
+DEFLATE_SUFFIXES = {".html", ".htm", ".js", ".json", ".jsonl", ".css", ".txt", ".csv", ".xml", ".svg", ".srt", ".log"}
+
+
+class ArchiveWriter:
+    # Builds <run_dir>.zip/.tar while the export runs: media files go in as soon as they are
+    # downloaded, the pages and journals are added on close. Writes happen on one background
+    # task in a thread, so the archive never blocks rendering and entries are never interleaved.
+    def __init__(self, run_dir: Path, kind: str) -> None:
+        self.run_dir = run_dir
+        self.kind = kind
+        self.path = Path(f"{run_dir}.{kind}")
+        # The archive only gets its final name once it is complete
+        self._part = Path(f"{self.path}.part")
+        self._added: set[str] = set()
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._zip: Optional[zipfile.ZipFile] = None
+        self._tar: Optional[tarfile.TarFile] = None
+        if kind == "zip":
+            self._zip = zipfile.ZipFile(self._part, "w", allowZip64=True)
+        else:
+            self._tar = tarfile.open(self._part, "w")
+        self._task = asyncio.create_task(self._writer())
+
+    def add(self, path: Path) -> None:
+        arcname = path.relative_to(self.run_dir).as_posix()
+        if arcname in self._added:
+            return
+        self._added.add(arcname)
+        self._queue.put_nowait((path, arcname))
+
+    async def _writer(self) -> None:
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+            path, arcname = item
+            try:
+                await asyncio.to_thread(self._write, path, arcname)
+            except Exception as e:  # noqa: BLE001
+                print(f"\nFailed to archive {arcname}: {e}")
+
+    def _write(self, path: Path, arcname: str) -> None:
+        if self._zip is not None:
+            compress = zipfile.ZIP_DEFLATED if path.suffix.lower() in DEFLATE_SUFFIXES else zipfile.ZIP_STORED
+            self._zip.write(path, arcname, compress_type=compress)
+        elif self._tar is not None:
+            self._tar.add(str(path), arcname)
+
+    def _close_file(self) -> None:
+        if self._zip is not None:
+            self._zip.close()
+        if self._tar is not None:
+            self._tar.close()
+
+    async def close(self) -> Path:
+        # Whatever was not added on the way (pages, journals, media kept from an interrupted run)
+        for path in sorted(self.run_dir.rglob("*")):
+            if path.is_file():
+                self.add(path)
+        self._queue.put_nowait(None)
+        await self._task
+        await asyncio.to_thread(self._close_file)
+        os.replace(self._part, self.path)
+        return self.path
+
+    async def abort(self) -> None:
+        # Drop what is still queued but let the entry being written finish before closing
+        while not self._queue.empty():
+            self._queue.get_nowait()
+        self._queue.put_nowait(None)
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._close_file()
+        self._part.unlink(missing_ok=True)
+
+
+@dataclass
+class ExportContext:
+    client: TelegramClient
+    args: argparse.Namespace
+    run_dir: Path
+    media_dir: Path
+    pool: DownloadPool
+    store: MediaStore
+    entities: EntityCache
+    transcriber: Transcriber
+    journal: Journal
+    archive: Optional[ArchiveWriter]
+    metrics: Metrics
+    # --thumbnail-first originals left for the pass after the pages: (message id, path in the run)
+    deferred: list[Tuple[int, str]]
+    derivatives: Optional[Derivatives] = None
+
+
+async def fetch_media(ctx: ExportContext, media: Any, target_path: Path, download: Callable[[Path], Awaitable[Any]], key: Optional[str] = None) -> Optional[str]:
+    if target_path.exists():
+        ctx.metrics.count("media_reused")
+        return str(target_path)
+
+    fetched = False
+
+    async def _timed_download(path: Path) -> Any:
+        nonlocal fetched
+        with ctx.metrics.phase("download"):
+            result = await download(path)
+        if result:
+            fetched = True
+            ctx.metrics.count("media_downloaded")
+            ctx.metrics.count("bytes_downloaded", Path(result).stat().st_size)
+        return result
+
+    key = key or media_store_key(media)
+    if not key:
+        result = await ctx.pool.submit(lambda: _timed_download(target_path))
+        if result and ctx.archive:
+            ctx.archive.add(Path(result))
+        return result
+    obj = await ctx.store.fetch(key, target_path.suffix, lambda tmp_path: ctx.pool.submit(lambda: _timed_download(tmp_path)))
+    if not obj:
+        return None
+    if not fetched:
+        ctx.metrics.count("media_reused")
+    link_or_copy(obj, target_path)
+    ctx.journal.media(os.path.relpath(str(target_path), str(ctx.run_dir)), target_path.stat().st_size)
+    if ctx.archive:
+        ctx.archive.add(target_path)
+    return str(target_path)
+
+
+def record_media_paths(rec: dict) -> list[str]:
+    # Files under the run directory a record's HTML points to
+    attachment = rec.get("attachment") or {}
+    return [rel for rel in (attachment.get("path"), attachment.get("thumb"), *(attachment.get("derived") or {}).values()) if rel]
+
+
+def carry_media(ctx: ExportContext, src_run_dir: Path, rec: dict) -> None:
+    # A record taken over from an earlier run brings its files along (hardlinks into the same store objects)
+    rels = record_media_paths(rec)
+    if "html" in rec:
+        # Records from before structured journals name their files only in the markup
+        rels = [f"media/{path.name}" for prefix in ("msg", "preview") for path in (src_run_dir / "media").glob(f"{prefix}_{rec['id']}_*")]
+    for rel in rels:
+        src = src_run_dir / rel
+        dst = ctx.run_dir / rel
+        if dst.exists() or not src.exists():
+            continue
+        try:
+            dst.parent.mkdir(parents=True, exist_ok=True)
+            link_or_copy(src, dst)
+        except OSError as e:
+            print(f"Failed to carry over {rel}: {e}")
+            continue
+        ctx.journal.media(rel, dst.stat().st_size)
+        if ctx.archive:
+            ctx.archive.add(dst)
+
+
+async def add_derivatives(ctx: ExportContext, message: Message, media: Any, path: Path, mimetype: Optional[str]) -> dict[str, str]:
+    # The derivative sits next to the file as <name>_<kind><suffix>, hardlinked from the store
+    document = message.document if isinstance(message.document, Document) else None
+    audio = next((a for a in (document.attributes if document else []) if isinstance(a, DocumentAttributeAudio)), None)
+    kind = ctx.derivatives.kind_for(mimetype, audio)
+    if not kind:
+        return {}
+    # Store objects are named by their SHA-256 already
+    obj = ctx.store.lookup(media_store_key(media))
     try:
-        result = await client(tl_functions.messages.TranscribeAudioRequest(peer="me", msg_id=message.id))
-        # result may be messages.TranscribedAudio with .text
-        text = getattr(result, "text", None)
-        if text:
-            return str(text).strip()
+        made = await ctx.derivatives.make(kind, path, obj.stem if obj else None, getattr(audio, "waveform", None))
     except Exception as e:  # noqa: BLE001
-        # Silently ignore if Telegram refuses or not supported
-        print(f"Telegram transcription failed for message {message.id}: {e}")
-        return None
-    return None
-    global _whisper_import_error_printed
+        print(f"Failed to make the {kind} derivative for message {message.id}: {e}")
+        return {}
+    if not made:
+        return {}
+    target = path.with_name(f"{path.stem}_{kind}{made.suffix}")
+    link_or_copy(made, target)
+    rel = os.path.relpath(str(target), str(ctx.run_dir))
+    ctx.journal.media(rel, target.stat().st_size)
+    if ctx.archive:
+        ctx.archive.add(target)
+    return {kind: rel}
+
+
+# Resume offsets are rounded down to a whole request so parts never straddle a 1 MB boundary
+RESUME_ALIGN = 512 * 1024
+
+
+async def download_resumable(client: TelegramClient, document: Document, path: Path) -> Optional[str]:
+    # Continue a partial file left by an interrupted run instead of starting from zero
+    parts_path = path.with_name(path.name + ".parts")
+    if parts_path.exists():
+        # Left by download_parallel(): the file is preallocated, its size says nothing
+        path.unlink(missing_ok=True)
+        parts_path.unlink()
+    offset = path.stat().st_size if path.exists() else 0
+    offset -= offset % RESUME_ALIGN
+    with path.open("r+b" if path.exists() else "wb") as fh:
+        fh.seek(offset)
+        fh.truncate()
+        async for chunk in client.iter_download(document, offset=offset, request_size=RESUME_ALIGN, file_size=document.size):
+            fh.write(chunk)
+        size = fh.tell()
+    if document.size and size != document.size:
+        # Keep the partial file; the retry picks up where this attempt stopped
+        raise OSError(f"incomplete download: {size} of {document.size} bytes")
+    return str(path)
+
+
+async def download_parallel(client: TelegramClient, document: Document, path: Path, parts: int) -> Optional[str]:
+    # A large document as concurrent byte ranges written in place into a preallocated file.
+    # Ranges are whole RESUME_ALIGN requests; every request written is logged to <file>.parts
+    # as "range end", so a retry (or the next run, through the store's stable tmp name)
+    # continues each range where it stopped.
+    size = document.size
+    requests = -(-size // RESUME_ALIGN)
+    per_part = -(-requests // parts)
+    ranges = [(start, min(size, start + per_part * RESUME_ALIGN)) for start in range(0, size, per_part * RESUME_ALIGN)]
+    parts_path = path.with_name(path.name + ".parts")
+    progress: dict[int, int] = {}
+    if path.exists() and parts_path.exists():
+        for line in parts_path.read_text(encoding="utf-8").splitlines():
+            fields = line.split()
+            if len(fields) == 2:
+                progress[int(fields[0])] = max(progress.get(int(fields[0]), 0), int(fields[1]))
+    else:
+        path.unlink(missing_ok=True)
+        parts_path.write_text("", encoding="utf-8")
+    with path.open("r+b" if path.exists() else "w+b") as fh:
+        fh.truncate(size)
+        if hasattr(os, "posix_fallocate"):
+            try:
+                # Reserve the blocks up front: no fragmentation, and a full disk fails here
+                os.posix_fallocate(fh.fileno(), 0, size)
+            except OSError:
+                pass
+
+        async def _part(idx: int, start: int, end: int) -> None:
+            offset = start
+            limit = -(-(end - start) // RESUME_ALIGN)
+            async for chunk in client.iter_download(document, offset=start, request_size=RESUME_ALIGN, limit=limit, file_size=size):
+                chunk = chunk[:end - offset]
+                # Parts share the file object; seek and write run without an await in between
+                fh.seek(offset)
+                fh.write(chunk)
+                fh.flush()
+                offset += len(chunk)
+                progress[idx] = offset
+                parts_log.write(f"{idx} {offset}\n")
+                parts_log.flush()
+            if offset != end:
+                raise OSError(f"incomplete range {start}-{end}: {offset - start} of {end - start} bytes")
+
+        parts_log = parts_path.open("a", encoding="utf-8")
+        tasks = [
+            asyncio.create_task(_part(idx, progress.get(idx, start), end))
+            for idx, (start, end) in enumerate(ranges)
+            if progress.get(idx, start) < end
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            # One failed range stops the others; what they wrote stays logged
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            parts_log.close()
+    # The file has its full length from the start, so what counts is what the ranges wrote
+    received = sum(min(progress.get(idx, start), end) - start for idx, (start, end) in enumerate(ranges))
+    if received != size:
+        raise OSError(f"incomplete download: {received} of {size} bytes")
+    parts_path.unlink()
+    return str(path)
+
+
+def download_original(ctx: ExportContext, message: Message, path: Path) -> Awaitable[Any]:
+    document = message.document
+    if isinstance(document, Document):
+        args = ctx.args
+        if args.parallel_download_bytes and args.parallel_download_parts > 1 and (document.size or 0) > args.parallel_download_bytes:
+            return download_parallel(ctx.client, document, path, args.parallel_download_parts)
+        return download_resumable(ctx.client, document, path)
+    return message.download_media(file=path)
+
+
+async def fetch_thumbnail(ctx: ExportContext, message: Message, media: Any, thumb: Any, target_path: Path, mimetype: Optional[str]) -> Optional[dict]:
+    # --thumbnail-first: the page gets the thumbnail right away; the original is linked from the
+    # store when an earlier run has it, left for fetch_originals() or skipped by policy.
+    # None means there is no thumbnail after all and the caller downloads the original as usual.
+    thumb_path = target_path.with_name(target_path.stem + "_thumb.jpg")
+    key = media_store_key(media)
     try:
-        import whisper  # type: ignore
+        downloaded = await fetch_media(ctx, media, thumb_path, lambda path: ctx.client.download_media(media, file=path, thumb=thumb), key=f"{key}_{thumb.type}")
     except Exception as e:  # noqa: BLE001
-        if not _whisper_import_error_printed:
-            print(f"Transcription disabled: whisper not available ({e}). Install 'openai-whisper' and ffmpeg.")
-            _whisper_import_error_printed = True
+        print(f"Failed to download thumbnail for message {message.id}: {e}")
         return None
+    if not downloaded:
+        return None
+    attachment = {"type": "file", "path": None, "mime": mimetype, "thumb": os.path.relpath(str(downloaded), str(ctx.run_dir)), "original": "skipped"}
+    if not wants_original(ctx.args, mimetype, original_size(media)):
+        ctx.metrics.count("originals_skipped")
+        return attachment
+    attachment["path"] = os.path.relpath(str(target_path), str(ctx.run_dir))
+    attachment["original"] = "deferred"
+    if target_path.exists() or ctx.store.lookup(key):
+        # Nothing to download, so nothing to wait for
+        await fetch_media(ctx, media, target_path, lambda path: download_original(ctx, message, path))
+    else:
+        ctx.deferred.append((message.id, attachment["path"]))
+    return attachment
 
-    def _run() -> str:
-        model = whisper.load_model(model_name)
-        # whisper expects str path
-        result = model.transcribe(str(local_path), language=language or None)
-        text = result.get("text") or ""
-        return text.strip()
 
-    try:
-        text: str = await asyncio.to_thread(_run)
-        return text or None
-    except Exception as e:  # noqa: BLE001
-        print(f"Transcription failed for {local_path}: {e}")
-        return None
+def pending_original(run_dir: Path, rec: dict) -> bool:
+    # A --thumbnail-first original that an interrupted (or failed) pass never delivered
+    attachment = rec.get("attachment") or {}
+    return attachment.get("original") == "deferred" and not (run_dir / attachment["path"]).exists()
 
 
-async def export_saved_messages(args: argparse.Namespace) -> Path:
-    output_dir = Path(args.output).expanduser().resolve()
-    output_dir.mkdir(parents=True, exist_ok=True)
-    run_dir, media_dir = ensure_output_dirs(output_dir)
+def needs_refetch(args: argparse.Namespace, rec: dict) -> bool:
+    # A placeholder an earlier run left instead of the media: a dry run, a failed download, or a
+    # file over a --max-bytes that has since been raised or lifted
+    attachment = rec.get("attachment") or {}
+    kind = attachment.get("type")
+    if args.dry_run:
+        return False
+    if kind in ("not_downloaded", "failed"):
+        return True
+    return kind == "skipped" and (not args.max_bytes or args.max_bytes > attachment.get("limit", 0))
+
+
+# Messages re-fetched by id per request (originals pass, placeholders of earlier runs)
+ORIGINALS_BATCH = 100
+
+
+async def fetch_originals(ctx: ExportContext, peer: Any, label: str = "") -> int:
+    # Second, low-priority pass of --thumbnail-first, after every page is written. Messages are
+    # fetched again by id, so file references are fresh and nothing is held in memory meanwhile;
+    # originals go through the download pool like any other media. Returns the failure count.
+    pending = ctx.deferred
+    failed = 0
+
+    async def _fetch(message: Optional[Message], rel: str) -> bool:
+        if not isinstance(message, Message) or not (message.photo or isinstance(message.document, Document)):
+            # Deleted since, or the media was removed by an edit
+            return False
+        media = message.document if isinstance(message.document, Document) else message.photo
+        try:
+            return bool(await fetch_media(ctx, media, ctx.run_dir / rel, lambda path: download_original(ctx, message, path)))
+        except Exception as e:  # noqa: BLE001
+            print(f"Failed to download the original for message {message.id}: {e}")
+            return False
+
+    for start in range(0, len(pending), ORIGINALS_BATCH):
+        batch = pending[start:start + ORIGINALS_BATCH]
+        messages = await ctx.client.get_messages(peer, ids=[msg_id for msg_id, _ in batch])
+        results = await asyncio.gather(*(_fetch(message, rel) for message, (_, rel) in zip(messages, batch)))
+        failed += results.count(False)
+        if not label:
+            print(f"\rFetching originals: {start + len(batch)} / {len(pending)}", end="", flush=True)
+    if pending and not label:
+        print()
+    ctx.metrics.count("originals_fetched", len(pending) - failed)
+    ctx.metrics.count("originals_failed", failed)
+    return failed
+
+
+async def refetch_media(ctx: ExportContext, peer: Any, msg_ids: list[int]) -> int:
+    # --resume: messages whose journaled files went missing or were damaged since. They are fetched
+    # again by id and extracted as in the export, which downloads only the files that are not
+    # there; the records, and so the pages, stay as they are. Returns how many are gone.
+    failed = 0
+    for start in range(0, len(msg_ids), ORIGINALS_BATCH):
+        messages = [message for message in await ctx.client.get_messages(peer, ids=msg_ids[start:start + ORIGINALS_BATCH]) if isinstance(message, Message)]
+        failed += min(ORIGINALS_BATCH, len(msg_ids) - start) - len(messages)
+        await asyncio.gather(*(
+            extract_record(ctx, message, message.date.astimezone(timezone.utc) if message.date.tzinfo else message.date.replace(tzinfo=timezone.utc))
+            for message in messages
+        ))
+    ctx.metrics.count("media_refetched", len(msg_ids) - failed)
+    return failed
+
+
+async def extract_record(ctx: ExportContext, message: Message, msg_dt_utc: datetime) -> dict:
+    # Everything the HTML is made of, fetched once: downloads, transcripts and forward
+    # sources happen here, render_record() turns the result into HTML without the network
+    client = ctx.client
+    args = ctx.args
+    run_dir = ctx.run_dir
+    media_dir = ctx.media_dir
+    msg_id = message.id
+    attachment: Optional[dict] = None
+    if message.media:
+        # Handle Telegram web page previews first
+        if isinstance(message.media, MessageMediaWebPage):
+            try:
+                webpage = message.media.webpage
+                attachment = {
+                    "type": "webpage",
+                    "site": getattr(webpage, "site_name", "") or "",
+                    "title": getattr(webpage, "title", "") or "",
+                    "description": getattr(webpage, "description", "") or "",
+                    "url": getattr(webpage, "url", "") or "",
+                    "thumb": None,
+                }
+                if getattr(webpage, "photo", None) and not args.dry_run:
+                    # Save thumbnail image next to media
+                    base_name = safe_filename(f"preview_{msg_id}_{message.date.strftime('%Y%m%d_%H%M%S')}") + ".jpg"
+                    target_path = media_dir / base_name
+                    try:
+                        downloaded = await fetch_media(ctx, webpage.photo, target_path, lambda path: client.download_media(webpage.photo, file=path))
+                        if downloaded:
+                            attachment["thumb"] = os.path.relpath(str(downloaded), str(run_dir))
+                    except Exception as e:  # noqa: BLE001
+                        ctx.metrics.count("media_failed")
+                        print(f"Failed to download link preview thumbnail for message {msg_id}: {e}")
+            except Exception as e:  # noqa: BLE001
+                attachment = {"type": "webpage", "error": str(e)}
+                print(f"Link preview rendering failed for message {msg_id}: {e}")
+        # Attempt to skip large files if requested
+        elif args.max_bytes and getattr(message, "document", None) and getattr(message.document, "size", 0) > args.max_bytes:
+            attachment = {"type": "skipped", "limit": args.max_bytes}
+            ctx.metrics.count("media_skipped")
+        elif args.dry_run:
+            attachment = {"type": "not_downloaded"}
+        else:
+            # Transcription does not need the file, so it runs alongside the download
+            transcript_task = asyncio.create_task(ctx.transcriber.transcribe(message))
+            # File name: msgid_date.ext
+            ext = detect_extension(message)
+            base_name = safe_filename(f"msg_{msg_id}_{message.date.strftime('%Y%m%d_%H%M%S')}") + ext
+            target_path = media_dir / base_name
+            rel_media_path = None
+            mimetype = None
+            if getattr(message, "document", None):
+                mimetype = getattr(message.document, "mime_type", None)
+            if getattr(message, "photo", None):
+                mimetype = "image/jpeg"
+            media = message.document if isinstance(message.document, Document) else message.photo
+            thumb = pick_thumbnail(media) if args.thumbnail_first and (mimetype or "").startswith(("image/", "video/")) else None
+            if thumb:
+                attachment = await fetch_thumbnail(ctx, message, media, thumb, target_path, mimetype)
+            derived: dict[str, str] = {}
+            if not attachment:
+                try:
+                    downloaded = await fetch_media(ctx, media, target_path, lambda path: download_original(ctx, message, path))
+                    if downloaded:
+                        rel_media_path = os.path.relpath(str(downloaded), str(run_dir))
+                        if ctx.derivatives:
+                            derived = await add_derivatives(ctx, message, media, Path(downloaded), mimetype)
+                except Exception as e:  # noqa: BLE001
+                    ctx.metrics.count("media_failed")
+                    print(f"Failed to download media for message {msg_id}: {e}")
+            if attachment:
+                attachment["transcript"] = await transcript_task
+            elif rel_media_path:
+                attachment = {"type": "file", "path": rel_media_path, "mime": mimetype, "transcript": await transcript_task}
+                if derived:
+                    attachment["derived"] = derived
+            else:
+                transcript_task.cancel()
+                attachment = {"type": "failed"}
+
+    return {
+        "id": msg_id,
+        "date": msg_dt_utc.isoformat(),
+        "edit": edit_timestamp(message),
+        "text": message.message or "",
+        "entities": [ent.to_dict() for ent in (message.entities or [])],
+        "fwd": await resolve_forward(ctx.entities, message),
+        "attachment": attachment,
+    }
+
+
+def render_batch(recs: list[dict], lang: str) -> Tuple[list[str], float]:
+    # Runs in the render thread or a worker process; the time goes to the "render" phase
+    started = time.perf_counter()
+    blocks = [render_record(rec, lang) for rec in recs]
+    return blocks, time.perf_counter() - started
+
+
+def render_record(rec: dict, lang: str) -> str:
+    # Journals written before records were kept only have the finished block
+    if "html" in rec:
+        return rec["html"]
+    msg_id = rec["id"]
+    date_str = format_ui_datetime(lang, datetime.fromisoformat(rec["date"]))
+    text_html = linkify_text(escape_text(rec.get("text")))
+
+    media_html = ""
+    attachment = rec.get("attachment") or {}
+    kind = attachment.get("type")
+    if kind == "webpage":
+        if attachment.get("error") is not None:
+            media_html = f'<div class="media"><span class="badge">link preview unavailable</span></div>'
+        else:
+            site = html.escape(attachment["site"])
+            title = html.escape(attachment["title"])
+            desc = html.escape(attachment["description"])
+            url = html.escape(attachment["url"])
+            thumb_rel = attachment.get("thumb")
+            img_html = f'<div class="thumb"><img src="{html.escape(thumb_rel)}" alt="preview"/></div>' if thumb_rel else '<div class="thumb"></div>'
+            meta_html = (
+                '<div class="meta">'
+                + (f'<div class="site">{site}</div>' if site else "")
+                + (f'<div class="title"><a href="{url}" target="_blank" rel="noopener noreferrer">{title or url}</a></div>')
+                + (f'<div class="desc">{desc}</div>' if desc else "")
+                + '</div>'
+            )
+            media_html = f'<div class="link-preview">{img_html}{meta_html}</div>'
+    elif kind == "skipped":
+        media_html = f'<span class="badge">media skipped (>{attachment["limit"]} bytes)</span>'
+    elif kind == "not_downloaded":
+        media_html = '<div class="media"><span class="badge">media not downloaded (dry-run)</span></div>'
+    elif kind == "file":
+        if attachment.get("thumb"):
+            # --thumbnail-first: the thumbnail links to the original, fetched later or skipped
+            img_html = f'<img class="media-img" src="{html.escape(attachment["thumb"])}" loading="lazy" alt="image" />'
+            if attachment.get("path"):
+                play_html = '<span class="play">&#9654;</span>' if (attachment.get("mime") or "").startswith("video/") else ""
+                tag_html = f'<a class="media-thumb" href="{html.escape(attachment["path"])}" target="_blank">{img_html}{play_html}</a>'
+            else:
+                tag_html = f'{img_html}<span class="badge">{t(lang, "original_skipped")}</span>'
+        else:
+            tag_html = decide_media_tag(attachment["path"], attachment.get("mime"), attachment.get("derived"))
+        transcript_html = ""
+        # Auto-use Telegram transcription for Premium accounts when embedding audio/video
+        transcript_text = attachment.get("transcript")
+        if transcript_text:
+            safe_transcript = html.escape(transcript_text)
+            label = "Текст" if lang == "ru" else "Transcription"
+            transcript_html = (
+                f'<details class="media"><summary class="badge">{label}</summary>'
+                f"<pre>{safe_transcript}</pre>"
+                "</details>"
+            )
+        media_html = f'<div class="media">{tag_html}{transcript_html}</div>'
+
+    fwd_html = ""
+    fwd_from_label = render_forwarded_from(rec.get("fwd"))
+    if fwd_from_label:
+        fwd_html = f'<div class="msg-fwd">{t(lang, "forwarded_from").format(source=fwd_from_label)}</div>'
+
+    block = (
+        f'<div class="message" id="msg-{msg_id}">'
+        f'<div class="msg-head"><span class="msg-id">#{msg_id}</span>'
+        f'<span class="msg-date">{html.escape(date_str)}</span></div>'
+        f'{fwd_html}'
+        f'<div class="msg-text">{text_html or ""}</div>'
+        f'{media_html}'
+        f"</div>"
+    )
+    return block
+
+
+async def export_saved_messages(
+    args: argparse.Namespace,
+    client: Optional[TelegramClient] = None,
+    peer: Any = "me",
+    store: Optional[MediaStore] = None,
+    label: str = "",
+    takeout: Optional[TelegramClient] = None,
+) -> Path:
+    metrics = Metrics()
+    RUN_METRICS.set(metrics)
+    if args.resume:
+        # Continue an interrupted run in place, with the settings it was started with
+        run_dir = Path(args.resume).expanduser().resolve()
+        if not (run_dir / MESSAGES_JOURNAL).exists():
+            raise ValueError(f"{run_dir} has no {MESSAGES_JOURNAL} to resume from")
+        output_dir = run_dir.parent
+        media_dir = run_dir / "media"
+        media_dir.mkdir(parents=True, exist_ok=True)
+        saved_settings = load_run_settings(run_dir)
+        for name in RESUME_SETTINGS:
+            if name in saved_settings:
+                setattr(args, name, saved_settings[name])
+        args.incremental = False
+        peer = (saved_settings.get("chat") or {}).get("peer", peer)
+    else:
+        output_dir = Path(args.output).expanduser().resolve()
+        output_dir.mkdir(parents=True, exist_ok=True)
+        run_dir, media_dir = ensure_output_dirs(output_dir)
+        saved_settings = {name: getattr(args, name) for name in RESUME_SETTINGS}
+        save_run_settings(run_dir, saved_settings)
 
     def _parse_ddmmyyyy(value: str) -> datetime:
         # Parse as UTC midnight
@@ -308,223 +2444,445 @@ async def export_saved_messages(args: argparse.Namespace) -> Path:
     else:
         until_dt_exclusive = None
 
-    # Initialize client: session can be file path or StringSession
-    session_arg: str | StringSession
-    if os.path.exists(args.session):
-        session_arg = args.session
-    else:
-        session_arg = StringSession(args.session) if args.session and len(args.session) > 100 else args.session
+    load_custom_translations(args.lang_file)
 
-    # Load custom translations if provided
-    global CUSTOM_TRANSLATIONS
-    CUSTOM_TRANSLATIONS = {}
-    if args.lang_file:
-        try:
-            CUSTOM_TRANSLATIONS = json.loads(Path(args.lang_file).read_text(encoding="utf-8"))
-            if not isinstance(CUSTOM_TRANSLATIONS, dict):
-                CUSTOM_TRANSLATIONS = {}
-        except Exception as e:  # noqa: BLE001
-            print(f"Failed to load language file {args.lang_file}: {e}")
+    # A ready client can be passed in: --targets shares one per account, bench.py runs the
+    # export against a local fake. Only a client created here is disconnected at the end.
+    own_client = client is None
+    if client is None:
+        client = make_client(args)
+    with metrics.phase("login"):
+        await ensure_login(client)
 
-    client = TelegramClient(session_arg, args.api_id, args.api_hash)
-    await ensure_login(client)
-
-    # Resolve current user's phone and username for title/header
+    # Resolve current user's phone and username for title/header; Premium status is checked once per run
+    is_premium = False
+    account: dict[str, Optional[str]] = {"phone": None, "username": None}
     try:
         me = await client.get_me()
+        is_premium = bool(getattr(me, "premium", False))
         me_phone = getattr(me, "phone", None)
-        me_username = getattr(me, "username", None)
-        phone_display = ("+" + me_phone) if me_phone and not me_phone.startswith("+") else (me_phone or None)
-        if args.lang == "ru":
-            if phone_display and me_username:
-                export_title = f"Сохранённые сообщения Telegram пользователя {phone_display} ({me_username})"
-            elif phone_display:
-                export_title = f"Сохранённые сообщения Telegram пользователя {phone_display}"
-            elif me_username:
-                export_title = f"Сохранённые сообщения Telegram пользователя {me_username}"
-            else:
-                export_title = t(args.lang, "title_base")
-        else:
-            if phone_display and me_username:
-                export_title = f"Telegram Saved Messages of {phone_display} ({me_username})"
-            elif phone_display:
-                export_title = f"Telegram Saved Messages of {phone_display}"
-            elif me_username:
-                export_title = f"Telegram Saved Messages of {me_username}"
-            else:
-                export_title = t(args.lang, "title_base")
+        account["username"] = getattr(me, "username", None)
+        account["phone"] = ("+" + me_phone) if me_phone and not me_phone.startswith("+") else (me_phone or None)
     except Exception:
-        export_title = t(args.lang, "title_base")
+        pass
+    # Saved Messages by default; --targets exports other dialogs as well
+    input_peer: Any = InputPeerSelf()
+    chat: Optional[dict] = None
+    if peer != "me":
+        entity = await client.get_entity(peer)
+        input_peer = await client.get_input_entity(entity)
+        chat = {"peer": peer, "name": entity_display_name(entity) or getattr(entity, "username", None) or str(peer)}
+    export_title = build_export_title(args.lang, account["phone"], account["username"], chat["name"] if chat else None)
+    # The render subcommand rebuilds the title from this, in whatever language it renders
+    saved_settings["account"] = account
+    if chat:
+        saved_settings["chat"] = chat
+    save_run_settings(run_dir, saved_settings)
 
     total = 0
-    messages_html: list[str] = []
     progress_total: Optional[int] = None
-    # Pre-count messages that match filters so the progress total reflects the export size
-    try:
-        cnt = 0
-        itc = client.iter_messages("me", reverse=args.reverse)
-        async for m in itc:
-            if not isinstance(m, Message):
+
+    # Incremental mode builds on the last complete run recorded in the state file. run.json keeps
+    # which one, so a resumed incremental run builds on the same run even if the state moved on
+    state = load_export_state(output_dir)
+    prev_run_dir: Optional[Path] = None
+    base: Optional[dict] = saved_settings.get("incremental") if args.resume else None
+    if base:
+        prev_run_dir = output_dir / base["run"]
+        if not (prev_run_dir / MESSAGES_JOURNAL).exists():
+            raise ValueError(f"{run_dir.name} builds on {base['run']}, which no longer exists")
+    elif args.incremental:
+        if args.since or args.until:
+            print("--incremental ignores --since/--until; fetching everything newer than the last export.")
+            since_dt = until_dt_exclusive = None
+        last_run = state.get("last_run")
+        if last_run and (output_dir / last_run / MESSAGES_JOURNAL).exists():
+            prev_run_dir = output_dir / last_run
+            base = {"run": last_run, "last_message_id": int(state.get("last_message_id", 0)), "reverse": bool(state.get("reverse"))}
+            saved_settings["incremental"] = base
+            save_run_settings(run_dir, saved_settings)
+        else:
+            print("No previous export state found; running a full export.")
+    last_message_id = int(base["last_message_id"]) if base else 0
+    max_message_id = last_message_id
+    prev_reverse = bool(base["reverse"]) if base else False
+    edit_dates: dict[str, int] = {}
+    # Messages the previous run has only a placeholder for are fetched again, like edited ones
+    refetch: set[int] = set()
+    if prev_run_dir:
+        edit_dates = dict(state.get("edit_dates", {}))
+        if args.resume:
+            # The state may have moved on since; the previous run's journal has the edits it holds
+            edit_dates = {}
+        for rec in iter_journal_records(prev_run_dir, reverse=prev_reverse, was_reverse=prev_reverse):
+            if args.resume:
+                edit_dates[str(rec["id"])] = int(rec.get("edit", 0))
+            if needs_refetch(args, rec):
+                refetch.add(int(rec["id"]))
+
+    if prev_run_dir:
+        edit_cutoff = datetime.now(timezone.utc) - timedelta(days=args.edit_window_days)
+    else:
+        # Ask the server for the size of the export instead of walking the history
+        with metrics.phase("count"):
+            progress_total = await count_messages(client, input_peer, since_dt, until_dt_exclusive)
+
+    # Blocks go to disk as soon as they are collected: the HTML page(s) plus the messages.jsonl journal
+    dirty_months: set[str] = set()
+    if args.resume:
+        # Pages of an incremental run can be hardlinks into the previous run: unlink, never overwrite
+        for old_page in [run_dir / "index.html", run_dir / "pages.js", *run_dir.glob("page_*.html")]:
+            old_page.unlink(missing_ok=True)
+    writer: HtmlWriter | ShardedHtmlWriter
+    if args.shard == "month":
+        # Unchanged month pages of the previous run can be reused only if they were rendered the same way
+        # (the render subcommand may have redone them since)
+        prev_layout = load_run_settings(prev_run_dir).get("rendered", state) if prev_run_dir else state
+        same_layout = prev_layout.get("shard") == "month" and bool(prev_layout.get("reverse")) == bool(args.reverse) and prev_layout.get("lang") == args.lang
+        # ... and with the search box only if this run has one too
+        same_layout = same_layout and prev_run_dir is not None and (prev_run_dir / SEARCH_DIR).is_dir() == (not args.no_search)
+        # A resumed run renders its written part up front, before it knows which months changed
+        same_layout = same_layout and not args.resume
+        writer = ShardedHtmlWriter(run_dir, export_title, args.lang, dirty_months, reuse_dir=prev_run_dir if same_layout else None, search=not args.no_search)
+    else:
+        writer = HtmlWriter(run_dir / "index.html", export_title, args.lang, search=not args.no_search)
+    search: Optional[SearchIndex] = None
+    # An incremental run appends its new and edited messages to a copy of the previous index
+    # (a real copy: the shards are appended to)
+    # (a resumed run replays its journal into a fresh index instead)
+    search_carried = bool(prev_run_dir and not args.resume and not args.no_search and (prev_run_dir / SEARCH_DIR).is_dir())
+    if search_carried:
+        shutil.rmtree(run_dir / SEARCH_DIR, ignore_errors=True)
+        shutil.copytree(prev_run_dir / SEARCH_DIR, run_dir / SEARCH_DIR)
+        search = SearchIndex(run_dir, reset=False)
+    elif not args.no_search:
+        search = SearchIndex(run_dir)
+    # Records of this run that the carried index does not have yet
+    fresh_ids: set[int] = set()
+    written = 0
+    done = 0
+    resume_from = 0
+
+    def already_written(msg_id: int) -> bool:
+        # The interrupted part of a resumed run ends at resume_from in page order
+        return bool(resume_from) and (msg_id <= resume_from if args.reverse else msg_id >= resume_from)
+
+    deferred: list[Tuple[int, str]] = []
+    # Messages of the interrupted run whose files are missing or damaged, fetched again after the pages
+    refetch_ids: list[int] = []
+    damaged: list[Path] = []
+    if args.resume:
+        # Re-render what the interrupted run already exported; iteration continues after its last message
+        media_sizes = {rec["media"]: rec.get("size") for rec in read_jsonl(run_dir / MESSAGES_JOURNAL) if "media" in rec}
+        broken = {rel for rel, size in media_sizes.items() if not (run_dir / rel).exists() or (run_dir / rel).stat().st_size != size}
+        damaged = [run_dir / rel for rel in broken if (run_dir / rel).exists()]
+        for rec in iter_journal_records(run_dir, reverse=args.reverse, was_reverse=args.reverse):
+            resume_from = int(rec["id"])
+            writer.write_block(resume_from, rec["date"], render_record(rec, args.lang))
+            if search:
+                search.add(rec)
+            if pending_original(run_dir, rec):
+                deferred.append((resume_from, rec["attachment"]["path"]))
+            elif broken.intersection(record_media_paths(rec)):
+                refetch_ids.append(resume_from)
+            edit_dates[str(resume_from)] = int(rec.get("edit", 0))
+            max_message_id = max(max_message_id, resume_from)
+            written += 1
+        done = written
+        # A resumed incremental run goes through the merge again; what it wrote before is skipped
+        refetch = {msg_id for msg_id in refetch if not already_written(msg_id)}
+        print(f"Resuming {run_dir.name} after {written} messages" + (f" ({len(broken)} media files missing or damaged, fetched again at the end)" if broken else ""))
+    journal = Journal(run_dir / MESSAGES_JOURNAL)
+    # Incremental records that have to be slotted in between the previous run's ones
+    held: dict[int, dict] = {}
+
+    # History and media go through the takeout session when one is granted
+    api: TelegramClient = client
+    takeout_stack = AsyncExitStack()
+    if takeout is not None:
+        # --targets opens one takeout per account and shares it between its targets
+        api = takeout
+    elif args.takeout:
+        api = await start_takeout(client, takeout_stack, files=not args.dry_run, max_file_size=args.max_bytes or None) or client
+
+    pool = DownloadPool(args.download_workers)
+    pool.start()
+    # Concurrent --targets exports share one store in the top-level output directory
+    own_store = store is None
+    if store is None:
+        store = MediaStore(output_dir / MEDIA_STORE_DIR)
+    if damaged:
+        store.evict(damaged)
+        for path in damaged:
+            path.unlink()
+    entities = EntityCache(client, output_dir / ENTITY_CACHE_FILE, ttl_seconds=args.entity_ttl_hours * 3600, metrics=metrics)
+    transcriber = Transcriber(client, output_dir / TRANSCRIPTS_FILE, input_peer, enabled=is_premium, workers=args.transcribe_workers, metrics=metrics)
+    archive = ArchiveWriter(run_dir, args.archive) if args.archive != "none" else None
+    if archive and args.resume:
+        # The interrupted run's archive was never finished; its media goes into a fresh one right away
+        for path in sorted(media_dir.iterdir()):
+            if path.is_file():
+                archive.add(path)
+    ctx = ExportContext(
+        client=api,
+        args=args,
+        run_dir=run_dir,
+        media_dir=media_dir,
+        pool=pool,
+        store=store,
+        entities=entities,
+        transcriber=transcriber,
+        journal=journal,
+        archive=archive,
+        metrics=metrics,
+        deferred=deferred,
+        derivatives=Derivatives(store, args.derivative_processes, metrics) if args.derivatives and not args.dry_run else None,
+    )
+    # Staged pipeline; every stage is a task handing work to the next one through a bounded
+    # queue, so a slow stage holds back the ones before it and memory stays flat:
+    # history fetch -> enrichment (downloads, transcripts, forward sources; one task per
+    # message) -> in-order collection -> batched rendering off the event loop -> output
+    messages_q: asyncio.Queue = asyncio.Queue(maxsize=HISTORY_PREFETCH)
+    extracted_q: asyncio.Queue = asyncio.Queue(maxsize=RENDER_WINDOW)
+    records_q: asyncio.Queue = asyncio.Queue(maxsize=RENDER_BATCH * 2)
+    rendered_q: asyncio.Queue = asyncio.Queue(maxsize=RENDER_QUEUE_BATCHES)
+    extract_tasks: set[asyncio.Task] = set()
+    render_executor: Executor
+    if args.render_processes > 0:
+        render_executor = ProcessPoolExecutor(
+            args.render_processes,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=load_custom_translations,
+            initargs=(args.lang_file,),
+        )
+    else:
+        # The render thread does not run in the export's context and loads the table itself
+        render_executor = ThreadPoolExecutor(1, initializer=load_custom_translations, initargs=(args.lang_file,))
+
+    async def _fetch_stage() -> None:
+        nonlocal total, max_message_id
+        # Iterate messages from Saved Messages, seeking straight to the requested window:
+        # newest-first starts just before --until, oldest-first starts at --since.
+        # Incremental runs always walk newest-first and stop below the edit re-check window.
+        # Pacing is left to the rate limiter rather than Telethon's fixed per-page wait.
+        if prev_run_dir:
+            it = api.iter_messages(input_peer, wait_time=0)
+        elif resume_from:
+            it = api.iter_messages(input_peer, reverse=args.reverse, offset_id=resume_from, wait_time=0)
+        elif args.reverse:
+            it = api.iter_messages(input_peer, reverse=True, offset_date=since_dt, wait_time=0)
+        else:
+            it = api.iter_messages(input_peer, offset_date=until_dt_exclusive, wait_time=0)
+        # Time spent waiting on history pages is the "iteration" phase
+        async for message in metrics.timed_iter(it, "iteration"):
+            if not isinstance(message, Message):
                 continue
-            dt = m.date
-            dt_utc = dt.astimezone(timezone.utc) if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
-            if since_dt and dt_utc < since_dt:
+            # Normalize message date to UTC and ensure tz-aware
+            msg_dt = message.date
+            msg_dt_utc = msg_dt.astimezone(timezone.utc) if msg_dt.tzinfo else msg_dt.replace(tzinfo=timezone.utc)
+            if prev_run_dir and message.id <= last_message_id:
+                if msg_dt_utc < edit_cutoff:
+                    break
+                # Already archived: only re-render when it was edited since
+                if edit_timestamp(message) == edit_dates.get(str(message.id), 0) and message.id not in refetch:
+                    continue
+            if prev_run_dir and already_written(message.id):
+                # Written before a resumed run was interrupted
                 continue
-            if until_dt_exclusive and dt_utc >= until_dt_exclusive:
+            # Once past the far end of the window nothing else can match
+            if since_dt and msg_dt_utc < since_dt:
+                if args.reverse:
+                    continue
+                break
+            if until_dt_exclusive and msg_dt_utc >= until_dt_exclusive:
+                if args.reverse:
+                    break
                 continue
-            cnt += 1
-        progress_total = cnt
-    except Exception:
-        progress_total = None
 
-    # Iterate messages from Saved Messages
-    it = client.iter_messages("me", reverse=args.reverse)
-    async for message in it:
-        if not isinstance(message, Message):
-            continue
-        # Normalize message date to UTC and ensure tz-aware
-        msg_dt = message.date
-        msg_dt_utc = msg_dt.astimezone(timezone.utc) if msg_dt.tzinfo else msg_dt.replace(tzinfo=timezone.utc)
-        if since_dt and msg_dt_utc < since_dt:
-            continue
-        if until_dt_exclusive and msg_dt_utc >= until_dt_exclusive:
-            continue
-
-        total += 1
-        if progress_total:
-            print(f"\rExporting messages: {total} / {progress_total}", end="", flush=True)
-        else:
-            print(f"\rExporting messages: {total}", end="", flush=True)
-        msg_id = message.id
-        date_str = format_ui_datetime(args.lang, msg_dt_utc)
-        text_html = linkify_text(escape_text(message.message))
-
-        media_html = ""
-        if message.media:
-            # Handle Telegram web page previews first
-            if isinstance(message.media, MessageMediaWebPage):
-                preview_html = ""
-                try:
-                    webpage = message.media.webpage
-                    site = html.escape(getattr(webpage, "site_name", "") or "")
-                    title = html.escape(getattr(webpage, "title", "") or "")
-                    desc = html.escape(getattr(webpage, "description", "") or "")
-                    url = html.escape(getattr(webpage, "url", "") or "")
-                    thumb_rel = None
-                    if getattr(webpage, "photo", None) and not args.dry_run:
-                        # Save thumbnail image next to media
-                        base_name = safe_filename(f"preview_{msg_id}_{message.date.strftime('%Y%m%d_%H%M%S')}") + ".jpg"
-                        target_path = media_dir / base_name
-                        try:
-                            downloaded = await client.download_media(webpage.photo, file=target_path)
-                            if downloaded:
-                                thumb_rel = os.path.relpath(str(downloaded), str(run_dir))
-                        except Exception as e:  # noqa: BLE001
-                            print(f"Failed to download link preview thumbnail for message {msg_id}: {e}")
-                    img_html = f'<div class="thumb"><img src="{html.escape(thumb_rel)}" alt="preview"/></div>' if thumb_rel else '<div class="thumb"></div>'
-                    meta_html = (
-                        '<div class="meta">'
-                        + (f'<div class="site">{site}</div>' if site else "")
-                        + (f'<div class="title"><a href="{url}" target="_blank" rel="noopener noreferrer">{title or url}</a></div>')
-                        + (f'<div class="desc">{desc}</div>' if desc else "")
-                        + '</div>'
-                    )
-                    preview_html = f'<div class="link-preview">{img_html}{meta_html}</div>'
-                except Exception as e:  # noqa: BLE001
-                    preview_html = f'<div class="media"><span class="badge">link preview unavailable</span></div>'
-                    print(f"Link preview rendering failed for message {msg_id}: {e}")
-                media_html = preview_html
+            total += 1
+            max_message_id = max(max_message_id, message.id)
+            edit_dates[str(message.id)] = edit_timestamp(message)
+            refetch.discard(message.id)
+            await messages_q.put((message, msg_dt_utc))
+        # Placeholders older than the edit window are fetched by id; the merge swaps them in
+        pending_ids = sorted(refetch)
+        for start in range(0, len(pending_ids), ORIGINALS_BATCH):
+            for message in await api.get_messages(input_peer, ids=pending_ids[start:start + ORIGINALS_BATCH]):
+                if not isinstance(message, Message):
+                    # Deleted since; the placeholder stays
+                    continue
+                msg_dt_utc = message.date.astimezone(timezone.utc) if message.date.tzinfo else message.date.replace(tzinfo=timezone.utc)
+                total += 1
+                edit_dates[str(message.id)] = edit_timestamp(message)
+                await messages_q.put((message, msg_dt_utc))
+        await messages_q.put(None)
+
+    async def _enrich_stage() -> None:
+        while True:
+            item = await messages_q.get()
+            if item is None:
+                break
+            message, msg_dt_utc = item
+            task = asyncio.create_task(extract_record(ctx, message, msg_dt_utc))
+            extract_tasks.add(task)
+            task.add_done_callback(extract_tasks.discard)
+            # A full queue means RENDER_WINDOW messages are already in flight
+            await extracted_q.put((message.id, msg_dt_utc.isoformat(), task))
+        await extracted_q.put(None)
+
+    async def _collect_stage() -> None:
+        nonlocal done
+        while True:
+            item = await extracted_q.get()
+            if item is None:
+                break
+            msg_id, date_iso, task = item
+            rec = await task
+            dirty_months.add(date_iso[:7])
+            if search_carried:
+                fresh_ids.add(msg_id)
+            if prev_run_dir and (args.reverse or msg_id <= last_message_id):
+                held[msg_id] = rec
             else:
-                # Attempt to skip large files if requested
-                if args.max_bytes and getattr(message, "document", None) and getattr(message.document, "size", 0) > args.max_bytes:
-                    media_html = f'<span class="badge">media skipped (>{args.max_bytes} bytes)</span>'
-                else:
-                    rel_media_path = None
-                    mimetype = None
-                    local_media_path: Optional[Path] = None
-                    if not args.dry_run:
-                        # File name: msgid_date.ext
-                        ext = detect_extension(message)
-                        base_name = safe_filename(f"msg_{msg_id}_{message.date.strftime('%Y%m%d_%H%M%S')}") + ext
-                        target_path = media_dir / base_name
-                        try:
-                            downloaded = await message.download_media(file=target_path)
-                            if downloaded:
-                                rel_media_path = os.path.relpath(str(downloaded), str(run_dir))
-                                local_media_path = Path(downloaded)
-                        except Exception as e:  # noqa: BLE001
-                            rel_media_path = None
-                            print(f"Failed to download media for message {msg_id}: {e}")
-                    # Try to detect mimetype after download
-                    if getattr(message, "document", None):
-                        mimetype = getattr(message.document, "mime_type", None)
-                    if getattr(message, "photo", None):
-                        mimetype = "image/jpeg"
-
-                    if rel_media_path:
-                        tag_html = decide_media_tag(rel_media_path, mimetype)
-                        transcript_html = ""
-                        # Auto-use Telegram transcription for Premium accounts when embedding audio/video
-                        transcript_text: Optional[str] = None
-                        transcript_text = await transcribe_with_telegram(client, message)
-                        if transcript_text:
-                            safe_transcript = html.escape(transcript_text)
-                            label = "Текст" if args.lang == "ru" else "Transcription"
-                            transcript_html = (
-                                f'<details class="media"><summary class="badge">{label}</summary>'
-                                f"<pre>{safe_transcript}</pre>"
-                                "</details>"
-                            )
-                        media_html = f'<div class="media">{tag_html}{transcript_html}</div>'
-                    else:
-                        if args.dry_run:
-                            media_html = '<div class="media"><span class="badge">media not downloaded (dry-run)</span></div>'
-
-        fwd_html = ""
-        fwd_from_label = await render_forwarded_from(client, message)
-        if fwd_from_label:
-            fwd_html = f'<div class="msg-fwd">{t(args.lang, "forwarded_from").format(source=fwd_from_label)}</div>'
-
-        block = (
-            f'<div class="message" id="msg-{msg_id}">'
-            f'<div class="msg-head"><span class="msg-id">#{msg_id}</span>'
-            f'<span class="msg-date">{html.escape(date_str)}</span></div>'
-            f'{fwd_html}'
-            f'<div class="msg-text">{text_html or ""}</div>'
-            f'{media_html}'
-            f"</div>"
-        )
-        messages_html.append(block)
-
-    # Reconcile last line to N / N if total was different
-    if progress_total and total != progress_total:
-        print(f"\rExporting messages: {total} / {total}", end="", flush=True)
-    print()
-
-    html_doc = (
-        "<!DOCTYPE html>\n"
-        "<html lang=\"en\">\n<head>\n<meta charset=\"utf-8\">\n"
-        f"<title>{html.escape(export_title)}</title>\n<style>{CSS_STYLE}</style>\n"
-        "</head>\n<body>\n"
-        "<div class=\"header\">\n"
-        f"  <h1 class=\"title\">{html.escape(export_title)}</h1>\n"
-        f"  <div class=\"meta\">{html.escape(t(args.lang, 'exported_at').format(when=format_ui_datetime(args.lang, datetime.now(timezone.utc)), count=total))}</div>\n"
-        "</div>\n"
-        "<div class=\"container\">\n"
-        + "\n".join(messages_html) +
-        "\n</div>\n</body>\n</html>\n"
-    )
-
-    index_path = run_dir / "index.html"
-    index_path.write_text(html_doc, encoding="utf-8")
-
-    # Zip the run directory
-    archive_base = str(run_dir)
-    zip_path = shutil.make_archive(archive_base, "zip", root_dir=str(run_dir))
-    print(f"Export complete. HTML: {index_path}\nArchive: {zip_path}")
+                await records_q.put(rec)
+            done += 1
+            # Concurrent --targets exports would overwrite each other's progress line
+            if label:
+                continue
+            if progress_total:
+                print(f"\rExporting messages: {done} / {progress_total}", end="", flush=True)
+            else:
+                print(f"\rExporting messages: {done}", end="", flush=True)
+
+        if not label:
+            # Reconcile last line to N / N if total was different
+            if progress_total and total != progress_total:
+                print(f"\rExporting messages: {total} / {total}", end="", flush=True)
+            print()
+
+        if prev_run_dir:
+            # Stream the previous run's records, swapping in re-fetched ones; new records
+            # that could not be written yet (oldest-first order) follow at the end
+            for rec in iter_journal_records(prev_run_dir, reverse=args.reverse, was_reverse=prev_reverse):
+                if already_written(int(rec["id"])):
+                    continue
+                if int(rec["id"]) in held:
+                    if search_carried:
+                        # Before the new version is added in the write stage
+                        search.remove(rec)
+                    await records_q.put(held.pop(int(rec["id"])))
+                    continue
+                carry_media(ctx, prev_run_dir, rec)
+                if pending_original(run_dir, rec):
+                    deferred.append((int(rec["id"]), rec["attachment"]["path"]))
+                await records_q.put(rec)
+            for msg_id in sorted(held, reverse=not args.reverse):
+                await records_q.put(held[msg_id])
+        await records_q.put(None)
+
+    async def _render_stage() -> None:
+        loop = asyncio.get_running_loop()
+        finished = False
+        while not finished:
+            batch = [await records_q.get()]
+            # Take whatever else is already waiting, so busy stretches render in large batches
+            while len(batch) < RENDER_BATCH and not records_q.empty():
+                batch.append(records_q.get_nowait())
+            if batch[-1] is None:
+                batch.pop()
+                finished = True
+            if batch:
+                await rendered_q.put((batch, loop.run_in_executor(render_executor, render_batch, batch, args.lang)))
+        await rendered_q.put(None)
+
+    async def _write_stage() -> None:
+        nonlocal written
+        while True:
+            item = await rendered_q.get()
+            if item is None:
+                break
+            batch, blocks_future = item
+            blocks, seconds = await blocks_future
+            metrics.add("render", seconds)
+            with metrics.phase("write"):
+                for rec, block in zip(batch, blocks):
+                    writer.write_block(rec["id"], rec["date"], block)
+                    journal.message(rec)
+            if search:
+                with metrics.phase("search"):
+                    for rec in batch:
+                        if not search_carried or rec["id"] in fresh_ids:
+                            search.add(rec)
+            written += len(batch)
+
+    stages = [asyncio.create_task(stage()) for stage in (_fetch_stage, _enrich_stage, _collect_stage, _render_stage, _write_stage)]
+    completed = False
+    try:
+        # The first failing stage stops the whole pipeline
+        finished_stages, _ = await asyncio.wait(stages, return_when=asyncio.FIRST_EXCEPTION)
+        for stage in finished_stages:
+            stage.result()
+        if refetch_ids:
+            gone = await refetch_media(ctx, input_peer, refetch_ids)
+            if gone:
+                print(f"{label}{gone} messages with missing media were deleted since and keep their broken links.")
+        if deferred:
+            with metrics.phase("originals"):
+                failed = await fetch_originals(ctx, input_peer, label)
+            if failed:
+                print(f"{label}{failed} originals could not be downloaded; --resume {run_dir} tries them again.")
+        completed = True
+    finally:
+        with metrics.phase("finalize"):
+            for stage in stages:
+                stage.cancel()
+            for task in list(extract_tasks):
+                task.cancel()
+            await asyncio.gather(*stages, return_exceptions=True)
+            await asyncio.to_thread(render_executor.shutdown, wait=True, cancel_futures=True)
+            await pool.close(cancel=not completed)
+            if ctx.derivatives:
+                await asyncio.to_thread(ctx.derivatives.close)
+            store.save()
+            entities.save()
+            transcriber.close()
+            journal.close()
+            if search:
+                search.flush()
+            writer.close(written)
+            try:
+                await takeout_stack.aclose()
+            except Exception as e:  # noqa: BLE001
+                print(f"Failed to finish the takeout session: {e}")
+            if archive and not completed:
+                await archive.abort()
+    index_path = writer.path
+    metrics.count("messages", total)
+    metrics.count("messages_written", written)
+    metrics.count("download_retries", pool.retries)
+
+    # Only a run that covers the whole history, media included, can serve as a base for --incremental
+    if not since_dt and not until_dt_exclusive and not args.dry_run:
+        save_export_state(output_dir, {
+            "last_run": run_dir.name,
+            "last_message_id": max_message_id,
+            "reverse": bool(args.reverse),
+            "shard": args.shard,
+            "lang": args.lang,
+            "edit_dates": edit_dates,
+        })
+
+    # Media is already in the archive; only the pages and journals are left to add
+    if archive:
+        with metrics.phase("archive"):
+            archive_path = await archive.close()
+        print(f"{label}Export complete. HTML: {index_path}\nArchive: {archive_path}")
+    else:
+        print(f"{label}Export complete. HTML: {index_path}")
     # Optionally prune old exports
     try:
         if args.keep_last and args.keep_last > 0:
+            prune_started = time.perf_counter()
             base_dir = Path(args.output).expanduser().resolve()
             # Collect all export run folders matching naming scheme
             runs = []
@@ -537,27 +2895,492 @@ async def export_saved_messages(args: argparse.Namespace) -> Path:
             to_delete = runs[:-args.keep_last] if len(runs) > args.keep_last else []
             for old_run in to_delete:
                 try:
-                    # Remove zip archive if exists
-                    zip_candidate = Path(str(old_run) + ".zip")
-                    if zip_candidate.exists():
-                        zip_candidate.unlink()
+                    # Remove the run's archive if exists
+                    for suffix in (".zip", ".tar"):
+                        archive_candidate = Path(str(old_run) + suffix)
+                        if archive_candidate.exists():
+                            archive_candidate.unlink()
                     # Remove the directory tree
                     shutil.rmtree(old_run, ignore_errors=True)
                     print(f"Pruned old export: {old_run}")
                 except Exception as e:  # noqa: BLE001
                     print(f"Failed to prune {old_run}: {e}")
+            # A shared store is collected once all targets are done
+            if to_delete and own_store:
+                removed = store.gc()
+                if removed:
+                    print(f"Removed {removed} unreferenced media objects from {store.root}")
+            metrics.add("prune", time.perf_counter() - prune_started)
     except Exception as e:  # noqa: BLE001
         print(f"Cleanup failed: {e}")
-    await client.disconnect()
+    metrics.write(run_dir, args.metrics_textfile)
+    if own_client:
+        await client.disconnect()
+    return run_dir
+
+
+# Exports of one account running at the same time, unless its "concurrency" says otherwise
+TARGET_CONCURRENCY = 2
+TARGETS_SUMMARY_FILE = "targets_summary.json"
+
+
+# Options of the client, which --targets creates once per account
+ACCOUNT_OPTIONS = ("session", "api_id", "api_hash")
+
+
+def target_args(args: argparse.Namespace, overrides: dict, where: str, per_target: bool = False) -> argparse.Namespace:
+    # Any command line option can be set per account or per target, by its long name
+    targs = argparse.Namespace(**vars(args))
+    for key, value in overrides.items():
+        name = key.replace("-", "_")
+        if not hasattr(targs, name) or name in ("targets", "resume"):
+            raise ValueError(f"{where}: unknown option {key!r}")
+        if per_target and name in ACCOUNT_OPTIONS:
+            raise ValueError(f"{where}: {key!r} can only be set per account")
+        setattr(targs, name, value)
+    return targs
+
+
+async def takeout_scopes(client: TelegramClient, peers: list[Any]) -> dict[str, bool]:
+    # The takeout flags a set of targets needs beyond private chats
+    scopes: dict[str, bool] = {}
+    for peer in peers:
+        if peer == "me":
+            continue
+        try:
+            entity = await client.get_entity(peer)
+        except Exception:  # noqa: BLE001
+            # The target reports it when it runs
+            continue
+        if isinstance(entity, (Chat, ChatForbidden)):
+            scopes["chats"] = True
+        elif isinstance(entity, (Channel, ChannelForbidden)):
+            scopes["megagroups" if getattr(entity, "megagroup", False) else "channels"] = True
+    return scopes
+
+
+async def export_targets(args: argparse.Namespace) -> list[dict]:
+    # {"accounts": [{"session": ..., "name": ..., "concurrency": N, "targets": ["me", "@channel",
+    #   {"peer": -100123, "name": ..., <options>}], <options>}]}
+    # Every account gets one client (one login, one connection and rate limiter) shared by its
+    # targets; accounts run side by side, targets of an account up to its concurrency limit.
+    # Each target has its own directory, <output>/<account>/<target>, with the usual runs,
+    # state and caches in it; the media store is shared by all of them.
+    config = json.loads(Path(args.targets).expanduser().read_text(encoding="utf-8"))
+    base_dir = Path(args.output).expanduser().resolve()
+    base_dir.mkdir(parents=True, exist_ok=True)
+    store = MediaStore(base_dir / MEDIA_STORE_DIR)
+    results: list[dict] = []
+
+    jobs: list[Tuple[dict, argparse.Namespace, list[Tuple[Any, str, argparse.Namespace]]]] = []
+    for idx, account in enumerate(config.get("accounts") or []):
+        acc_options = {k: v for k, v in account.items() if k not in ("name", "concurrency", "targets")}
+        acc_args = target_args(args, acc_options, f"account #{idx + 1}")
+        # A StringSession makes a poor directory name
+        session_name = Path(acc_args.session).stem if len(acc_args.session) <= 100 else ""
+        acc_name = safe_filename(str(account.get("name") or session_name or f"account{idx + 1}"))
+        targets = []
+        for target in account.get("targets") or ["me"]:
+            if not isinstance(target, dict):
+                target = {"peer": target}
+            peer = target.get("peer", "me")
+            name = safe_filename(str(target.get("name") or peer).lstrip("@"))
+            options = {k: v for k, v in target.items() if k not in ("peer", "name")}
+            targs = target_args(acc_args, options, f"{acc_name}/{name}", per_target=True)
+            targs.output = str(base_dir / acc_name / name)
+            # Targets would overwrite each other's textfile unless they name their own
+            if not ({"metrics_textfile", "metrics-textfile"} & set(options)):
+                targs.metrics_textfile = ""
+            targets.append((peer, name, targs))
+        jobs.append(({"name": acc_name, "concurrency": account.get("concurrency", TARGET_CONCURRENCY)}, acc_args, targets))
+
+    # Logins may ask for codes on the terminal, so they happen one account at a time
+    clients: dict[str, Optional[ExportClient]] = {}
+    for account, acc_args, _ in jobs:
+        client = make_client(acc_args)
+        try:
+            await ensure_login(client)
+            clients[account["name"]] = client
+        except Exception as e:  # noqa: BLE001
+            print(f"[{account['name']}] Login failed: {e}")
+            clients[account["name"]] = None
+            await client.disconnect()
+
+    async def _target(client: ExportClient, takeout: Optional[TelegramClient], sem: asyncio.Semaphore, account: str, peer: Any, name: str, targs: argparse.Namespace) -> None:
+        label = f"[{account}/{name}] "
+        result: dict[str, Any] = {"account": account, "target": name, "peer": peer, "output": targs.output}
+        async with sem:
+            started = time.perf_counter()
+            print(f"{label}Exporting")
+            try:
+                run_dir = await export_saved_messages(targs, client, peer=peer, store=store, label=label, takeout=(takeout or client) if targs.takeout else None)
+                result.update(status="ok", run=str(run_dir))
+                try:
+                    counters = json.loads((run_dir / METRICS_FILE).read_text(encoding="utf-8"))["counters"]
+                    result.update(messages=counters.get("messages", 0), media=counters.get("media_downloaded", 0), bytes=counters.get("bytes_downloaded", 0))
+                except Exception:
+                    pass
+            except Exception as e:  # noqa: BLE001
+                print(f"{label}Export failed: {e}")
+                result.update(status="failed", error=str(e))
+            result["seconds"] = round(time.perf_counter() - started, 1)
+        results.append(result)
+
+    async def _account(account: dict, targets: list[Tuple[Any, str, argparse.Namespace]]) -> None:
+        client = clients[account["name"]]
+        if client is None:
+            results.extend({"account": account["name"], "target": name, "peer": peer, "status": "failed", "error": "login failed"} for peer, name, _ in targets)
+            return
+        sem = asyncio.Semaphore(max(1, int(account["concurrency"])))
+        stack = AsyncExitStack()
+        try:
+            # A session holds a single takeout, so concurrent targets share one that covers all of them
+            takeout = None
+            takeout_targets = [(peer, targs) for peer, _, targs in targets if targs.takeout]
+            if takeout_targets:
+                takeout = await start_takeout(
+                    client, stack,
+                    files=any(not targs.dry_run for _, targs in takeout_targets),
+                    max_file_size=None if any(not targs.max_bytes for _, targs in takeout_targets) else max(targs.max_bytes for _, targs in takeout_targets),
+                    label=f"[{account['name']}] ",
+                    **await takeout_scopes(client, [peer for peer, _ in takeout_targets]),
+                )
+            await asyncio.gather(*(_target(client, takeout, sem, account["name"], peer, name, targs) for peer, name, targs in targets))
+        finally:
+            try:
+                await stack.aclose()
+            except Exception as e:  # noqa: BLE001
+                print(f"[{account['name']}] Failed to finish the takeout session: {e}")
+            await client.disconnect()
+
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(_account(account, targets) for account, _, targets in jobs))
+    finally:
+        store.save()
+    if any(targs.keep_last for _, _, targets in jobs for _, _, targs in targets):
+        removed = store.gc()
+        if removed:
+            print(f"Removed {removed} unreferenced media objects from {store.root}")
+
+    summary = {"finished": datetime.now(timezone.utc).isoformat(), "wall_seconds": round(time.perf_counter() - started, 1), "targets": results}
+    (base_dir / TARGETS_SUMMARY_FILE).write_text(json.dumps(summary, indent=2, ensure_ascii=False), encoding="utf-8")
+    print(f"\nExported {sum(r['status'] == 'ok' for r in results)} of {len(results)} targets in {summary['wall_seconds']}s:")
+    for r in results:
+        detail = f"{r.get('messages', 0)} messages, {r['seconds']}s" if r["status"] == "ok" else r.get("error", "")
+        print(f"  {r['account']}/{r['target']}: {r['status']} ({detail})")
+    return results
+
+
+# --watch gathers the events of a burst for this long before writing anything
+WATCH_BATCH_SECONDS = 2.0
+WATCH_STAGING_DIR = ".watch"
+
+
+async def watch_saved_messages(args: argparse.Namespace, client: TelegramClient, run_dir: Path) -> None:
+    # --watch: after the initial export the client stays connected and new and edited messages
+    # are folded into the same run directory. Events of a burst are handled in one go: records
+    # are extracted as in the export and appended to the journal (iter_journal_records sorts
+    # them in), the page holding them (with --shard month the month's page, plus pages.js and
+    # the index) is spliced into a staging directory and swapped in, and the search index is
+    # appended to. The archive is rebuilt at most every --watch-archive-minutes. Deletions are
+    # not tracked.
+    output_dir = run_dir.parent
+    media_dir = run_dir / "media"
+    settings = load_run_settings(run_dir)
+    peer = (settings.get("chat") or {}).get("peer", "me")
+    input_peer: Any = InputPeerSelf() if peer == "me" else await client.get_input_entity(peer)
+    account = settings.get("account") or {}
+    # The layout the pages currently have, which the render subcommand may have changed
+    layout = settings.get("rendered") or settings
+    lang = layout.get("lang") or args.lang
+    title = build_export_title(lang, account.get("phone"), account.get("username"), (settings.get("chat") or {}).get("name"))
+    reverse = bool(layout.get("reverse"))
+    sharded = layout.get("shard") == "month"
+    state = load_export_state(output_dir)
+    # Only a run that is the --incremental base keeps the state file current
+    track_state = state.get("last_run") == run_dir.name
+
+    known: dict[int, int] = {}
+    # Where the current record of each message starts in the journal, for the search index to drop its words on an edit
+    offsets: dict[int, int] = {}
+    offset = 0
+    with (run_dir / MESSAGES_JOURNAL).open("rb") as fh:
+        for line in fh:
+            if _JOURNAL_ID_RE.match(line):
+                rec = json.loads(line)
+                known[int(rec["id"])] = int(rec.get("edit", 0))
+                offsets[int(rec["id"])] = offset
+            offset += len(line)
+    newest = max(known, default=0)
+    is_premium = False
+    try:
+        is_premium = bool(getattr(await client.get_me(), "premium", False))
+    except Exception:
+        pass
+
+    # The session adds to the metrics of the export it follows; metrics.json is rewritten after every batch
+    metrics = RUN_METRICS.get() or Metrics()
+    RUN_METRICS.set(metrics)
+    pool = DownloadPool(args.download_workers)
+    pool.start()
+    store = MediaStore(output_dir / MEDIA_STORE_DIR)
+    entities = EntityCache(client, output_dir / ENTITY_CACHE_FILE, ttl_seconds=args.entity_ttl_hours * 3600, metrics=metrics)
+    transcriber = Transcriber(client, output_dir / TRANSCRIPTS_FILE, input_peer, enabled=is_premium, workers=args.transcribe_workers, metrics=metrics)
+    search = SearchIndex(run_dir, reset=False) if (run_dir / SEARCH_DIR).is_dir() else None
+    ctx = ExportContext(
+        client=client,
+        args=args,
+        run_dir=run_dir,
+        media_dir=media_dir,
+        pool=pool,
+        store=store,
+        entities=entities,
+        transcriber=transcriber,
+        journal=Journal(run_dir / MESSAGES_JOURNAL),
+        archive=None,
+        metrics=metrics,
+        deferred=[],
+        derivatives=Derivatives(store, args.derivative_processes, metrics) if args.derivatives and not args.dry_run else None,
+    )
+
+    pending: dict[int, Message] = {}
+    wake = asyncio.Event()
+
+    async def _on_message(event: Any) -> None:
+        message = event.message
+        if message.id in known and edit_timestamp(message) == known[message.id]:
+            # Reactions, views and the like arrive as edits too
+            return
+        if message.id not in known and message.id < newest:
+            # An edit to a message outside the exported window
+            return
+        pending[message.id] = message
+        wake.set()
+
+    def _rewrite(updates: dict[int, dict], previous: dict[int, dict]) -> None:
+        # Pages are written in the staging directory and moved over the old ones; old files can
+        # be hardlinks into earlier runs and must never be written in place
+        staging = run_dir / WATCH_STAGING_DIR
+        shutil.rmtree(staging, ignore_errors=True)
+        staging.mkdir()
+        if sharded:
+            writer = ShardedHtmlWriter(staging, title, lang, set(), search=search is not None)
+            pages = load_pages(run_dir)
+            by_file: dict[str, dict[int, dict]] = {}
+            for msg_id in sorted(updates):
+                month = updates[msg_id]["date"][:7]
+                candidates = [p for p in pages if p["month"] == month]
+                if candidates:
+                    page = next((p for p in candidates if p["min"] <= msg_id <= p["max"]), candidates[-1] if reverse else candidates[0])
+                else:
+                    # New messages are the newest, so a new month goes at the newest end
+                    page = {"file": f"page_{month}.html", "month": month, "count": 0, "min": msg_id, "max": msg_id}
+                    pages.insert(len(pages) if reverse else 0, page)
+                by_file.setdefault(page["file"], {})[msg_id] = updates[msg_id]
+            for page in pages:
+                page_updates = by_file.get(page["file"])
+                if not page_updates:
+                    continue
+                page_writer = writer.page_writer(page["file"], page["month"])
+                try:
+                    page["count"] = splice_page(run_dir / page["file"], page_writer, page_updates, lang, reverse)
+                finally:
+                    page_writer.close(page["count"])
+                page["min"] = min(page["min"], min(page_updates))
+                page["max"] = max(page["max"], max(page_updates))
+            writer.write_index(pages, sum(p["count"] for p in pages))
+        else:
+            page_writer = HtmlWriter(staging / "index.html", title, lang, search=search is not None)
+            count = 0
+            try:
+                count = splice_page(run_dir / "index.html", page_writer, updates, lang, reverse)
+            finally:
+                page_writer.close(count)
+        if search:
+            for msg_id, rec in updates.items():
+                if msg_id in previous:
+                    search.remove(previous[msg_id])
+                search.add(rec)
+            search.flush()
+        for path in staging.iterdir():
+            os.replace(path, run_dir / path.name)
+        staging.rmdir()
+
+    def _read_previous(msg_ids: list[int]) -> dict[int, dict]:
+        previous: dict[int, dict] = {}
+        with (run_dir / MESSAGES_JOURNAL).open("rb") as fh:
+            for msg_id in msg_ids:
+                fh.seek(offsets[msg_id])
+                previous[msg_id] = json.loads(fh.readline())
+        return previous
+
+    async def _flush(batch: dict[int, Message]) -> None:
+        messages = [batch[msg_id] for msg_id in sorted(batch)]
+        recs = await asyncio.gather(*(
+            extract_record(ctx, message, message.date.astimezone(timezone.utc) if message.date.tzinfo else message.date.replace(tzinfo=timezone.utc))
+            for message in messages
+        ))
+        updates = {int(rec["id"]): rec for rec in recs}
+        previous = _read_previous([msg_id for msg_id in updates if msg_id in offsets]) if search else {}
+        # A later record of a message supersedes the earlier one; a retried batch just appends again
+        appended = {msg_id: ctx.journal.message(rec) for msg_id, rec in updates.items()}
+        await asyncio.to_thread(_rewrite, updates, previous)
+        nonlocal newest
+        edited = sum(1 for msg_id in updates if msg_id in known)
+        for message in messages:
+            known[message.id] = edit_timestamp(message)
+        offsets.update(appended)
+        newest = max(newest, max(batch))
+        if ctx.deferred:
+            await fetch_originals(ctx, input_peer)
+            ctx.deferred.clear()
+        store.save()
+        if track_state:
+            state["last_message_id"] = max(int(state.get("last_message_id", 0)), max(updates))
+            state.setdefault("edit_dates", {}).update({str(msg_id): edit for msg_id, edit in known.items() if msg_id in updates})
+            save_export_state(output_dir, state)
+        metrics.count("watch_batches")
+        metrics.count("watch_messages_new", len(updates) - edited)
+        metrics.count("watch_messages_edited", edited)
+        metrics.write(run_dir, args.metrics_textfile)
+        print(f"{datetime.now().strftime('%H:%M:%S')} {len(updates) - edited} new, {edited} edited message(s) written to {run_dir.name}")
+
+    async def _rebuild_archive() -> None:
+        if args.archive != "none":
+            with metrics.phase("archive"):
+                archive_path = await ArchiveWriter(run_dir, args.archive).close()
+            print(f"Archive updated: {archive_path}")
+
+    client.add_event_handler(_on_message, events.NewMessage(chats=[input_peer]))
+    client.add_event_handler(_on_message, events.MessageEdited(chats=[input_peer]))
+    print("Watching for new messages (Ctrl+C to stop)...")
+    archive_due: Optional[float] = None
+    try:
+        while True:
+            timeout = max(0.0, archive_due - time.monotonic()) if archive_due is not None else None
+            try:
+                await asyncio.wait_for(wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                await _rebuild_archive()
+                archive_due = None
+                continue
+            # Let the rest of the burst arrive
+            await asyncio.sleep(WATCH_BATCH_SECONDS)
+            wake.clear()
+            batch = dict(pending)
+            pending.clear()
+            try:
+                await _flush(batch)
+            except Exception as e:  # noqa: BLE001
+                print(f"Failed to write {len(batch)} message(s), retrying with the next batch: {e}")
+                for msg_id, message in batch.items():
+                    pending.setdefault(msg_id, message)
+                wake.set()
+                await asyncio.sleep(WATCH_BATCH_SECONDS * 5)
+                continue
+            if archive_due is None:
+                archive_due = time.monotonic() + args.watch_archive_minutes * 60
+    finally:
+        client.remove_event_handler(_on_message)
+        await pool.close(cancel=True)
+        if ctx.derivatives:
+            await asyncio.to_thread(ctx.derivatives.close)
+        store.save()
+        entities.save()
+        transcriber.close()
+        ctx.journal.close()
+        # Whatever changed since the last rebuild still goes into the archive
+        if archive_due is not None:
+            await _rebuild_archive()
+        metrics.write(run_dir, args.metrics_textfile)
+
+
+async def export_and_watch(args: argparse.Namespace) -> None:
+    client = make_client(args)
+    try:
+        run_dir = await export_saved_messages(args, client)
+        await watch_saved_messages(args, client, run_dir)
+    finally:
+        await client.disconnect()
+
+
+async def render_run(args: argparse.Namespace) -> Path:
+    run_dir = Path(args.run_dir).expanduser().resolve()
+    if not (run_dir / MESSAGES_JOURNAL).exists():
+        raise ValueError(f"{run_dir} has no {MESSAGES_JOURNAL} to render from")
+    started = time.perf_counter()
+    settings = load_run_settings(run_dir)
+    layout = settings.get("rendered") or settings
+    lang = args.lang or layout.get("lang") or "ru"
+    reverse = bool(layout.get("reverse")) if args.reverse is None else args.reverse
+    shard = args.shard or layout.get("shard") or "none"
+    load_custom_translations(args.lang_file)
+    account = settings.get("account") or {}
+    title = build_export_title(lang, account.get("phone"), account.get("username"), (settings.get("chat") or {}).get("name"))
+
+    # Pages of an incremental run can be hardlinks into the previous run: unlink, never overwrite
+    for old_page in [run_dir / "index.html", run_dir / "pages.js", *run_dir.glob("page_*.html")]:
+        old_page.unlink(missing_ok=True)
+    # The search index does not depend on language or layout and is kept as it is
+    has_search = (run_dir / SEARCH_DIR).is_dir()
+    writer: HtmlWriter | ShardedHtmlWriter
+    if shard == "month":
+        writer = ShardedHtmlWriter(run_dir, title, lang, set(), search=has_search)
+    else:
+        writer = HtmlWriter(run_dir / "index.html", title, lang, search=has_search)
+    count = 0
+    try:
+        # The journal is in export order, which --reverse at export time decided
+        for rec in iter_journal_records(run_dir, reverse=reverse, was_reverse=bool(settings.get("reverse"))):
+            writer.write_block(int(rec["id"]), rec["date"], render_record(rec, lang))
+            count += 1
+    finally:
+        writer.close(count)
+    settings["rendered"] = {"reverse": reverse, "shard": shard, "lang": lang}
+    save_run_settings(run_dir, settings)
+    print(f"Rendered {count} messages in {time.perf_counter() - started:.1f}s: {writer.path}")
+
+    # An existing archive would still hold the old pages
+    for kind in ("zip", "tar"):
+        if Path(f"{run_dir}.{kind}").exists():
+            archive_path = await ArchiveWriter(run_dir, kind).close()
+            print(f"Archive: {archive_path}")
     return run_dir
 
 
 def main() -> int:
+    if sys.argv[1:2] == ["render"]:
+        try:
+            asyncio.run(render_run(parse_render_args(sys.argv[2:])))
+            return 0
+        except Exception as e:  # noqa: BLE001
+            print(f"Error: {e}")
+            return 1
     args = parse_args()
-    if not args.api_id or not args.api_hash:
+    # With --targets the credentials can also come from the config, per account
+    if not args.targets and (not args.api_id or not args.api_hash):
         print("Missing API credentials. Set --api-id/--api-hash or TELEGRAM_API_ID/TELEGRAM_API_HASH.")
         return 2
     try:
+        if args.targets:
+            if args.resume:
+                print("--resume continues a single run: point it at the target's run directory without --targets.")
+                return 2
+            if args.watch:
+                print("--watch follows a single export and cannot be combined with --targets.")
+                return 2
+            results = asyncio.run(export_targets(args))
+            return 0 if all(r["status"] == "ok" for r in results) else 1
+        if args.watch:
+            if args.until:
+                print("--watch needs an export without --until.")
+                return 2
+            try:
+                asyncio.run(export_and_watch(args))
+            except KeyboardInterrupt:
+                print("Stopped watching.")
+            return 0
         asyncio.run(export_saved_messages(args))
         return 0
     except KeyboardInterrupt: